@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from scratch2py import sb
+from scratch2py.__main__ import ScratchEnv, SCREEN_WIDTH, SCREEN_HEIGHT
+
+from .projects import PROJECTS
+
+DRAW_FRAMES = 200
+
+
+def load(filename):
+    sb.tasks_by_hat.clear()
+    return ScratchEnv(filename, None, pacing=sb.Pacing("turbo"))
+
+
+def bench_loader(filename):
+    # A first start, with empty caches
+    shared = os.environ["SCRATCH2PY_CACHE"]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["SCRATCH2PY_CACHE"] = cache_dir
+        try:
+            start = time.perf_counter()
+            load(filename)
+            return time.perf_counter() - start
+        finally:
+            os.environ["SCRATCH2PY_CACHE"] = shared
+
+
+def bench_warm_loader(filename):
+    # Starting again, with the parsed project and costumes cached
+    load(filename)
+    start = time.perf_counter()
+    load(filename)
+    return time.perf_counter() - start
+
+
+def bench_interpreter(filename):
+    env = load(filename)
+    scheduler = sb.scheduler
+
+    start = time.perf_counter()
+    env.post_event(sb.HatFlagClicked())
+    # Frame by frame, so that conditions only checked once a frame are
+    # checked too
+    while env.deliver_events() or not scheduler.is_idle():
+        scheduler.run_frame()
+    return time.perf_counter() - start
+
+
+def bench_renderer(filename):
+    env = load(filename)
+    screen = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+    sprites = env.get_sprites()
+
+    start = time.perf_counter()
+    for frame in range(DRAW_FRAMES):
+        for sprite in sprites:
+            sprite.turn_clockwise(7)
+            sprite.next_costume()
+        env.draw(screen)
+    return time.perf_counter() - start
+
+
+BENCHMARKS = {
+    "loader": bench_loader,
+    "warm_loader": bench_warm_loader,
+    "interpreter": bench_interpreter,
+    "renderer": bench_renderer,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Keep the caches of the benchmarks out of the user's
+        os.environ["SCRATCH2PY_CACHE"] = os.path.join(tmp_dir, "cache")
+        for name in names:
+            filename = os.path.join(tmp_dir, name + ".sb3")
+            PROJECTS[name]().save(filename)
+
+            results[name] = {}
+            for bench, func in BENCHMARKS.items():
+                times = [func(filename) for i in range(repeat)]
+                results[name][bench] = {"min": min(times),
+                                        "mean": sum(times) / len(times)}
+                print("{:<14} {:<12} {:9.4f} s".format(name, bench, min(times)))
+
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(baseline, current):
+    print()
+    print("{:<14} {:<12} {:>10} {:>10} {:>8}".format("project", "benchmark",
+                                                      "baseline", "current", "ratio"))
+    for name, benches in current["results"].items():
+        for bench, result in benches.items():
+            try:
+                old = baseline["results"][name][bench]["min"]
+            except KeyError:
+                continue
+            if result["min"] == 0:
+                continue
+            print("{:<14} {:<12} {:10.4f} {:10.4f} {:7.2f}x".format(
+                name, bench, old, result["min"], old / result["min"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks")
+    parser.add_argument("projects", nargs="*",
+                        help="projects to benchmark (default: all of {})"
+                        .format(", ".join(PROJECTS)))
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="compare with an earlier results file")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for name in args.projects:
+        if name not in PROJECTS:
+            parser.error("unknown project {}".format(name))
+
+    pygame.init()
+    results = run(args.projects or list(PROJECTS), args.repeat)
+
+    if args.output is not None:
+        with open(args.output, "w") as fobj:
+            json.dump(results, fobj, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fobj:
+            compare(json.load(fobj), results)
+
+
+if __name__ == "__main__":
+    main()
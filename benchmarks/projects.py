@@ -0,0 +1,255 @@
+import io
+import json
+import hashlib
+
+from zipfile import ZipFile
+
+import pygame
+
+
+def num(value):
+    return [1, [4, str(value)]]
+
+
+def whole(value):
+    return [1, [6, str(value)]]
+
+
+def text(value):
+    return [1, [10, str(value)]]
+
+
+def var(name):
+    return [3, [12, name, name], [10, ""]]
+
+
+def expr(bid):
+    return [3, bid, [10, ""]]
+
+
+def substack(bid):
+    return [2, bid]
+
+
+def message(name):
+    return [1, [11, name, name]]
+
+
+class Scripts:
+    def __init__(self):
+        self.blocks = {}
+
+    def block(self, opcode, inputs=None, fields=None):
+        bid = "b{}".format(len(self.blocks))
+        self.blocks[bid] = {
+            "opcode": opcode,
+            "next": None,
+            "parent": None,
+            "inputs": inputs or {},
+            "fields": fields or {},
+            "topLevel": False,
+        }
+        return bid
+
+    def stack(self, *bids):
+        for prev, bid in zip(bids, bids[1:]):
+            self.blocks[prev]["next"] = bid
+            self.blocks[bid]["parent"] = prev
+        return bids[0]
+
+    def hat(self, opcode, *body, fields=None):
+        bid = self.block(opcode, fields=fields)
+        self.blocks[bid]["topLevel"] = True
+        return self.stack(bid, *body)
+
+    def set_var(self, name, value):
+        return self.block("data_setvariableto", {"VALUE": value},
+                          {"VARIABLE": [name, name]})
+
+    def repeat(self, times, *body):
+        return self.block("control_repeat", {"TIMES": whole(times),
+                                             "SUBSTACK": substack(self.stack(*body))})
+
+    def op(self, opcode, **inputs):
+        return self.block(opcode, {k.upper(): v for k, v in inputs.items()})
+
+
+class Project:
+    def __init__(self):
+        self._assets = {}
+        self._targets = []
+
+    def _add_asset(self, data, fmt, name, size):
+        md5 = hashlib.md5(data).hexdigest()
+        self._assets[md5 + "." + fmt] = data
+        return {
+            "name": name,
+            "assetId": md5,
+            "md5ext": md5 + "." + fmt,
+            "dataFormat": fmt,
+            "rotationCenterX": size[0] // 2,
+            "rotationCenterY": size[1] // 2,
+        }
+
+    def png_costume(self, name, size, color):
+        surface = pygame.Surface(size, pygame.SRCALPHA)
+        pygame.draw.ellipse(surface, color, surface.get_rect())
+        png = io.BytesIO()
+        pygame.image.save(surface, png, "costume.png")
+        return self._add_asset(png.getvalue(), "png", name, size)
+
+    def svg_costume(self, name, size, shapes, seed=0):
+        width, height = size
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}">'
+                 .format(width, height)]
+        for i in range(shapes):
+            k = i * 7919 + seed * 104729
+            parts.append('<circle cx="{}" cy="{}" r="{}" fill="#{:06x}" opacity="0.5"/>'
+                         .format(k % width, (k // width) % height, 5 + k % 40,
+                                 k & 0xFFFFFF))
+        parts.append("</svg>")
+        return self._add_asset("".join(parts).encode("utf-8"), "svg", name, size)
+
+    def add_stage(self, costumes, variables=(), scripts=None):
+        self._targets.append({
+            "isStage": True,
+            "name": "Stage",
+            "variables": {name: [name, 0] for name in variables},
+            "blocks": scripts.blocks if scripts is not None else {},
+            "currentCostume": 0,
+            "costumes": costumes,
+            "sounds": [],
+        })
+
+    def add_sprite(self, name, costumes, variables=(), scripts=None,
+                   x=0, y=0, direction=90):
+        self._targets.append({
+            "isStage": False,
+            "name": name,
+            "variables": {v: [v, 0] for v in variables},
+            "blocks": scripts.blocks if scripts is not None else {},
+            "currentCostume": 0,
+            "costumes": costumes,
+            "sounds": [],
+            "x": x,
+            "y": y,
+            "size": 100,
+            "direction": direction,
+            "visible": True,
+            "layerOrder": len(self._targets),
+        })
+
+    def save(self, filename):
+        proj = {"targets": self._targets, "meta": {"semver": "3.0.0"}}
+        with ZipFile(filename, "w") as zip_file:
+            zip_file.writestr("project.json", json.dumps(proj))
+            for name, data in self._assets.items():
+                zip_file.writestr(name, data)
+
+
+def _plain_stage(proj, variables=()):
+    proj.add_stage([proj.png_costume("backdrop", (480, 360), (255, 255, 255))],
+                   variables)
+
+
+def repeat_loops():
+    proj = Project()
+    _plain_stage(proj)
+
+    s = Scripts()
+    inc = s.set_var("n", expr(s.op("operator_add", num1=var("n"), num2=num(1))))
+    s.hat("event_whenflagclicked",
+          s.set_var("n", num(0)),
+          s.repeat(20, s.repeat(20, s.repeat(20, inc))))
+
+    proj.add_sprite("Looper", [proj.png_costume("c", (32, 32), (255, 0, 0))],
+                    ["n"], s)
+    return proj
+
+
+def arithmetic():
+    proj = Project()
+    _plain_stage(proj)
+
+    s = Scripts()
+    step = s.op("operator_mod",
+                num1=expr(s.op("operator_divide",
+                               num1=expr(s.op("operator_subtract",
+                                              num1=expr(s.op("operator_multiply",
+                                                             num1=expr(s.op("operator_add",
+                                                                            num1=var("x"),
+                                                                            num2=num(3))),
+                                                             num2=num(7))),
+                                              num2=var("x"))),
+                               num2=num(3))),
+                num2=num(1000))
+    cond = s.op("operator_gt", operand1=var("x"), operand2=num(500))
+    s.hat("event_whenflagclicked",
+          s.set_var("x", num(1)),
+          s.repeat(4000,
+                   s.set_var("x", expr(step)),
+                   s.block("control_if", {"CONDITION": expr(cond),
+                                          "SUBSTACK": substack(s.set_var("y", var("x")))})))
+
+    proj.add_sprite("Calculator", [proj.png_costume("c", (32, 32), (0, 0, 255))],
+                    ["x", "y"], s)
+    return proj
+
+
+def many_sprites(count=40, costumes=4):
+    proj = Project()
+    _plain_stage(proj)
+
+    for i in range(count):
+        s = Scripts()
+        s.hat("event_whenflagclicked",
+              s.repeat(30,
+                       s.block("looks_nextcostume"),
+                       s.block("motion_movesteps", {"STEPS": num(5)}),
+                       s.block("motion_ifonedgebounce")))
+
+        looks = [proj.png_costume("c{}".format(j), (48 + 8 * j, 48),
+                                  (i * 6 % 256, j * 60 % 256, 128))
+                 for j in range(costumes)]
+        proj.add_sprite("Sprite{}".format(i), looks, scripts=s,
+                        x=(i * 37) % 400 - 200, y=(i * 53) % 300 - 150,
+                        direction=(i * 29) % 360)
+    return proj
+
+
+def broadcasts(receivers=20, sends=200):
+    proj = Project()
+    _plain_stage(proj, ["received"])
+    costume = proj.png_costume("c", (32, 32), (0, 128, 0))
+
+    s = Scripts()
+    s.hat("event_whenflagclicked",
+          s.repeat(sends, s.block("event_broadcastandwait",
+                                  {"BROADCAST_INPUT": message("ping")})))
+    proj.add_sprite("Sender", [costume], scripts=s)
+
+    for i in range(receivers):
+        s = Scripts()
+        add = s.op("operator_add", num1=var("received"), num2=num(1))
+        s.hat("event_whenbroadcastreceived", s.set_var("received", expr(add)),
+              fields={"BROADCAST_OPTION": ["ping", "ping"]})
+        proj.add_sprite("Receiver{}".format(i), [costume], scripts=s)
+    return proj
+
+
+def large_svg(count=8, shapes=2000):
+    proj = Project()
+    proj.add_stage([proj.svg_costume("backdrop", (480, 360), shapes)])
+    looks = [proj.svg_costume("c{}".format(i), (480, 360), shapes, seed=i + 1)
+             for i in range(count)]
+    proj.add_sprite("Vector", looks)
+    return proj
+
+
+PROJECTS = {
+    "repeat_loops": repeat_loops,
+    "arithmetic": arithmetic,
+    "many_sprites": many_sprites,
+    "broadcasts": broadcasts,
+    "large_svg": large_svg,
+}
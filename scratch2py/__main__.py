@@ -1,27 +1,47 @@
+import os
 import sys
 import json
-import io
+import time
+import argparse
 import importlib
 import queue
 import math
+import random
+import pickle
 
 from zipfile import ZipFile
 from pprint import pprint
 from queue import Queue
 from threading import get_ident
-from collections import namedtuple
+from collections import namedtuple, Counter
+
+# batch writes its reports to stdout, which pygame's banner would break
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
 
-import cairosvg
 import pygame
 
 from . import sb
+from . import codegen
+from .batch import find_projects, run_batch
+from .replay import Recorder, Replay
+from .parsecache import get_parse_cache, parse_key
+from .assets import ImageLoader, get_raster_cache
+from .render import TransformCache, DirtyRenderer, Layers
+from .render import surface_bytes, mask_bytes
+from .spatial import SpatialHash, bb_overlap
+from .telemetry import FrameTimer
+from .timers import TimerWheel
 from .vm import Parser
 from .vm import VM
+from .vm import Stats
+from .vm import Profiler
 
 SCREEN_WIDTH = 480
 SCREEN_HEIGHT = 360
+FPS = 40
 
 BB = namedtuple("BB", "x, y, w, h")
+Transformed = namedtuple("Transformed", "surface, mask")
 
 
 def scratch_to_pygame_coord(x, y):
@@ -49,15 +69,21 @@ class Sound:
         if fmt != "wav":
             raise ValueError("Unsupported sound dataFormat {}".format(fmt))
 
-        snd_file = env.open_file(si["md5ext"])
-        # print(si["md5ext"], type(snd_file))
-        
+        self._env = env
+        self._md5ext = si["md5ext"]
+        self._snd = None
+
+    def _load(self):
+        snd_file = self._env.open_file(self._md5ext)
         try:
-            self._snd = pygame.mixer.Sound(snd_file.read())
+            return pygame.mixer.Sound(snd_file.read())
         except pygame.error as exc:
-            raise ValueError("Error reading sound file {}: {}".format(si["md5ext"], exc))
+            print("Warning: Error reading sound file {}: {}".format(self._md5ext, exc))
+            return DummySound(self._env, {"name": self.name})
 
     def play(self):
+        if self._snd is None:
+            self._snd = self._load()
         self._snd.play()
 
 
@@ -69,90 +95,77 @@ class Costume:
         self._rot_cy = ci["rotationCenterY"]
         self._bmp_res = ci.get("bitmapResolution", 1)
         # print("BMP Resolution", self._bmp_res)
-        fmt = ci["dataFormat"]
-        img_file = env.open_file(ci["md5ext"])
-
-        if fmt == "png":
-            self._img = self._load_png(img_file)
-        elif fmt == "svg":
-            self._img = self._load_svg(img_file)
-        elif fmt == "jpg":
-            self._img = self._load_jpg(img_file)
-        else:
-            raise ValueError("Unsupported dataFormat {}".format(fmt))
-
-        self._cached = {}
-
-    def _load_png(self, fobj):
-        png = fobj.read()
-        return pygame.image.load(io.BytesIO(png), "xyz.png")
+        self._env = env
+        self._info = ci
+        self._img = None
+        self._transforms = env.get_transform_cache()
 
-    def _load_jpg(self, fobj):
-        jpg = fobj.read()
-        return pygame.image.load(io.BytesIO(jpg), "xyz.jpg")
+    def load(self):
+        if self._img is None:
+            self._img = self._env.load_image(self._info)
+        return self._img
 
-    def _load_svg(self, fobj):
-        png = cairosvg.svg2png(file_obj=fobj)
-        return self._load_png(io.BytesIO(png))
+    def prefetch(self):
+        if self._img is None:
+            self._env.prefetch_image(self._info)
 
     def _scale_rotate(self, size, direction):
-        cached = self._cached.get((size, direction), None)
+        key = self._transforms.quantize(size, direction)
+        cached = self._transforms.get(self, key)
         if cached is not None:
             return cached
-                    
-        scaled = pygame.transform.scale(self._img,
-                                        (int(self._img.get_width() * size // 100 // self._bmp_res),
-                                         int(self._img.get_height() * size // 100 // self._bmp_res)))
+
+        size, direction = key
+        img = self.load()
+        scaled = pygame.transform.scale(img,
+                                        (int(img.get_width() * size // 100 // self._bmp_res),
+                                         int(img.get_height() * size // 100 // self._bmp_res)))
         rotated = pygame.transform.rotate(scaled, 90 - direction)
-        self._cached[(size, direction)] = rotated
+        mask = pygame.mask.from_surface(rotated)
+        self._transforms.put(self, key, Transformed(rotated, mask),
+                             surface_bytes(rotated) + mask_bytes(mask))
 
-        return rotated
+        return Transformed(rotated, mask)
+
+    def _get_pos(self, x, y):
+        x, y = scratch_to_pygame_coord(x - self._rot_cx / self._bmp_res,
+                                       y + self._rot_cy / self._bmp_res)
+        return int(round(x)), int(round(y))
 
     def touches(self, x, y, size, direction, pos_x, pos_y):
-        rotated = self._scale_rotate(size, direction)
+        mask = self._scale_rotate(size, direction).mask
 
-        sprite_x, sprite_y = scratch_to_pygame_coord(x, y)
+        left, top = self._get_pos(x, y)
         pos_x, pos_y = scratch_to_pygame_coord(pos_x, pos_y)
+        pos_x = int(pos_x) - left
+        pos_y = int(pos_y) - top
 
-        pos_x += rotated.get_width() // 2
-        pos_y += rotated.get_height() // 2
-
-        pos_x -= sprite_x
-        pos_y -= sprite_y
-
-        if pos_x < 0 or pos_y < 0:
+        width, height = mask.get_size()
+        if pos_x < 0 or pos_y < 0 or pos_x >= width or pos_y >= height:
             return False
 
-        if pos_x > rotated.get_width() or pos_y > rotated.get_height():
-            return False
-
-        r, g, b, a = rotated.get_at((pos_x, pos_y))
-        if a == 0:
-            return False
-
-        return True
+        return bool(mask.get_at((pos_x, pos_y)))
 
     def draw(self, x, y, size, direction, screen):
-        rotated = self._scale_rotate(size, direction)
-        x, y = scratch_to_pygame_coord(x - self._rot_cx / self._bmp_res,
-                                       y + self._rot_cy / self._bmp_res)
-        screen.blit(rotated, (x, y))
+        rotated = self._scale_rotate(size, direction).surface
+        screen.blit(rotated, self._get_pos(x, y))
 
     def get_bb(self, x, y, size, direction):
-        cached = self._cached.get((size, direction), None)
-        if cached == None:
-            return BB(0, 0, 0, 0)  # FIXME?
-        else:
-            x, y = scratch_to_pygame_coord(x - self._rot_cx / self._bmp_res,
-                                           y + self._rot_cy / self._bmp_res)
-            return BB(x, y, cached.get_width(), cached.get_height())
+        rotated = self._scale_rotate(size, direction).surface
+        x, y = self._get_pos(x, y)
+        return BB(x, y, rotated.get_width(), rotated.get_height())
+
+    def get_mask(self, size, direction):
+        return self._scale_rotate(size, direction).mask
 
 
 class Target:
-    def __init__(self, info, gvars):
+    def __init__(self, env, info, gvars):
         self._blocks = info["blocks"]
-        self._parser = Parser(info, gvars)
+        self._parser = Parser(info, gvars, env.get_parsed(info["name"]))
         self._gvars = gvars
+        self._vm = VM(self, gvars, env.get_stats())
+        self._bubble = None
 
     def _load_sounds(self, env, si):
         sound_map = {}
@@ -173,17 +186,32 @@ class Target:
             costumes.append(costume)
         return costumes
 
+    def get_costume(self):
+        return self._costumes[self._curr_costume]
+
+    def _changed(self):
+        self._env.target_changed(self)
+
+    def _costume_changed(self):
+        self.get_costume().load()
+        self._changed()
+
+        # Costumes are usually cycled through in order
+        following = (self._curr_costume + 1) % len(self._costumes)
+        self._costumes[following].prefetch()
+
     def next_costume(self):
         self._curr_costume += 1
         self._curr_costume %= len(self._costumes)
+        self._costume_changed()
 
     def draw(self, screen):
         if self._visible:
             # print("Drawing ...", self.name, self.x, self.y)
-            self._costumes[self._curr_costume].draw(self.x, self.y,
-                                                    self._size,
-                                                    self._direction,
-                                                    screen)
+            self.get_costume().draw(self.x, self.y,
+                                    self._size,
+                                    self._direction,
+                                    screen)
 
     def _get_costume_by_name(self, name):
         for i, costume in enumerate(self._costumes):
@@ -194,23 +222,32 @@ class Target:
 
     def switch_costume(self, name):
         self._curr_costume = self._get_costume_by_name(name)
+        self._costume_changed()
 
     def get_hat_actions(self):
         hat_actions = []
 
-        for script, hat in self._parser.get_hats():
-            action = VM(self, self._gvars).get_runner(script)
-            hat_actions.append((hat, action))
+        for code, hat in self._parser.compile(self._vm):
+            hat_actions.append((hat, self._vm.get_runner(code)))
 
         return hat_actions
 
     def get_variables(self):
-        return self._parser.get_variable_map()
+        return self._parser.get_variables()
+
+    def get_parsed(self):
+        return self._parser.get_parsed()
+
+    def get_vm(self):
+        return self._vm
+
+    def get_env(self):
+        return self._env
 
 
 class Stage(Target):
     def __init__(self, env, stage_info):
-        Target.__init__(self, stage_info, {})
+        Target.__init__(self, env, stage_info, None)
         
         si = stage_info
         self._env = env
@@ -227,7 +264,7 @@ class Stage(Target):
 
 class Sprite(Target):
     def __init__(self, env, sprite_info, stage):
-        Target.__init__(self, sprite_info, stage.get_variables())
+        Target.__init__(self, env, sprite_info, stage.get_variables())
         
         si = sprite_info
         self._env = env
@@ -243,6 +280,24 @@ class Sprite(Target):
         self._blocks = si["blocks"]
         self.name = si["name"]
 
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, x):
+        self._x = x
+        self._changed()
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, y):
+        self._y = y
+        self._changed()
+
     def go_to_xy(self, x, y):
         self.x = x
         self.y = y
@@ -261,21 +316,27 @@ class Sprite(Target):
 
     def set_size_to(self, size):
         self._size = size
+        self._changed()
 
     def point_in_direction(self, direction):
         self._direction = direction
+        self._changed()
 
     def turn_anti_clockwise(self, degrees):
         self._direction -= degrees
+        self._changed()
 
     def turn_clockwise(self, degrees):
         self._direction += degrees
+        self._changed()
 
     def touches(self, x, y):
-        return self._costumes[self._curr_costume].touches(self.x, self.y,
-                                                          self._size,
-                                                          self._direction,
-                                                          x, y)
+        if not self._visible:
+            return False
+        return self.get_costume().touches(self.x, self.y,
+                                          self._size,
+                                          self._direction,
+                                          x, y)
 
     def start_sound(self, name):
         self._sounds[name].play()
@@ -283,30 +344,72 @@ class Sprite(Target):
     def stop_all_sounds(self):
         pygame.mixer.stop()
 
+    def _show_bubble(self, kind, msg):
+        self._bubble = (kind, msg) if msg != "" else None
+        if msg != "":
+            self._env.record_speech(self, kind, msg)
+            print(msg)
+
     def say(self, msg):
-        print(msg)
+        self._show_bubble("say", msg)
+
+    def think(self, msg):
+        self._show_bubble("think", msg)
+
+    def get_bubble(self):
+        return self._bubble
 
     def dump_blocks(self):
         vm = VM(self, self._blocks)
         for bid, _ in vm.get_hats():
             vm.dump(bid)
 
-    def _bb_collision(self, bb1, bb2):
-        return not ((bb1.x > bb2.x + bb2.w - 1) or # is b1 on the right side of b2?
-                    (bb1.y > bb2.y + bb2.h - 1) or # is b1 under b2?
-                    (bb2.x > bb1.x + bb1.w - 1) or # is b2 on the right side of b1?
-                    (bb2.y > bb1.y + bb1.h - 1))   # is b2 under b1?
+    def overlaps(self, sprite, bb1, bb2):
+        offset = (bb2.x - bb1.x, bb2.y - bb1.y)
+        return self.get_mask().overlap(sprite.get_mask(), offset) is not None
 
     def touching(self, name):
         sprite = self._env.get_sprite_by_name(name)
-        bb1 = self.get_bb()
-        bb2 = sprite.get_bb()
-        return self._bb_collision(bb1, bb2)
-        
+        return self._env.is_touching(self, sprite)
+
+    def touching_any(self):
+        return self._env.get_touching(self)
+
     def get_bb(self):
-        return self._costumes[self._curr_costume].get_bb(self.x, self.y,
-                                                         self._size,
-                                                         self._direction)
+        return self.get_costume().get_bb(self.x, self.y,
+                                         self._size,
+                                         self._direction)
+
+    def get_mask(self):
+        return self.get_costume().get_mask(self._size, self._direction)
+
+    def get_rect(self):
+        if not self._visible:
+            return None
+        return pygame.Rect(self.get_bb())
+
+    def go_to_front(self):
+        self._env.get_layers().go_to_front(self)
+        self._changed()
+
+    def go_to_back(self):
+        self._env.get_layers().go_to_back(self)
+        self._changed()
+
+    def go_forward_layers(self, layers):
+        self._env.get_layers().go_forward(self, layers)
+        self._changed()
+
+    def is_visible(self):
+        return self._visible
+
+    def show(self):
+        self._visible = True
+        self._changed()
+
+    def hide(self):
+        self._visible = False
+        self._changed()
 
     def move(self, steps):
         theta = math.radians(90 - self._direction)
@@ -320,26 +423,162 @@ class Sprite(Target):
         
         if (self.x > maxx or self.x < minx or self.y > maxy or self.y < miny):
             self._direction = -self._direction
+            self._changed()
 
 class ScratchEnv:
-    def __init__(self, proj_filename, package_name):
+    def __init__(self, proj_filename, package_name, compiled_package=None,
+                 threaded=False, pacing=None, stats=None, jobs=None,
+                 prefetch_costumes=False, transform_cache=None):
         self._zip_file = ZipFile(proj_filename)
-        self._proj = self._load_project()
+        self._stats = stats
+        self._parse_cache = get_parse_cache()
+        self._parse_key = None
+        self._proj, self._parsed = self._load_project(proj_filename)
         self._package_name = package_name
+        self._compiled_package = compiled_package
+        self._pacing = pacing if pacing is not None else sb.Pacing(fps=FPS)
+        # Scripts waiting for a time are parked here until their frame
+        self._timers = TimerWheel(1.0 / self._pacing.fps)
+        self._scheduler = None if threaded else sb.Scheduler(self._pacing, self._timers)
+        self._events = sb.EventQueue()
+        self._speech = []
+        self._stopped = False
+        sb.pacing = self._pacing
+        sb.scheduler = self._scheduler
         if package_name is None:
             self._package = None
         else:
             self._package = importlib.import_module(package_name)
-        self._stage = self._load_stage()
-        self._sprites = self._load_sprites()
+
+        if transform_cache is None:
+            transform_cache = TransformCache()
+        self._transform_cache = transform_cache
+        self._spatial = SpatialHash()
+        self._renderer = DirtyRenderer()
+        self._frame_timer = self._make_frame_timer()
+        self._overlay_font = None
+
+        # Only the costumes shown at startup are decoded now, the rest
+        # on first use.
+        self._prefetch_costumes = prefetch_costumes
+        self._images = ImageLoader(self._zip_file, jobs, get_raster_cache())
+        self._images.prefetch(target["costumes"][target["currentCostume"]]
+                              for target in self._proj["targets"])
+        try:
+            self._stage = self._load_stage()
+            self._sprites = self._load_sprites()
+            self._layers = Layers(self._sprites.values())
+            self._save_parsed()
+            self._stage.get_costume().load()
+            for sprite in self._sprites.values():
+                sprite.get_costume().load()
+        finally:
+            if not prefetch_costumes:
+                self._images.close()
+            self._images.trim_cache()
+
+    def get_stats(self):
+        return self._stats
+
+    def record_speech(self, target, kind, message):
+        self._speech.append({"time": sb.clock.now(), "sprite": target.name,
+                             "kind": kind, "message": message})
+
+    def get_speech(self):
+        return self._speech
+
+    def get_variable_values(self):
+        values = {}
+        for target in [self._stage] + list(self._sprites.values()):
+            store = target.get_variables()
+            values[target.name] = {
+                "variables": {name: variable.get_value()
+                              for name, variable in store.get_variable_map().items()},
+                "lists": {name: list(variable.get_value())
+                          for name, variable in store.get_list_map().items()},
+            }
+        return values
+
+    def get_position(self, name):
+        if name == "_random_":
+            return (random.randint(-SCREEN_WIDTH // 2, SCREEN_WIDTH // 2),
+                    random.randint(-SCREEN_HEIGHT // 2, SCREEN_HEIGHT // 2))
+        elif name == "_mouse_":
+            return pygame_to_scratch_coord(*pygame.mouse.get_pos())
+
+        sprite = self._sprites[name]
+        return sprite.x, sprite.y
 
     def open_file(self, filename):
         return self._zip_file.open(filename, "r")
+
+    def target_changed(self, target):
+        self._renderer.mark(target)
+        if isinstance(target, Sprite):
+            self._spatial.mark(target)
+
+    def is_touching(self, sprite, other):
+        # Hidden sprites touch nothing
+        if not (sprite.is_visible() and other.is_visible()):
+            return False
+        bb1 = self._spatial.get_bb(sprite)
+        bb2 = self._spatial.get_bb(other)
+        return bb_overlap(bb1, bb2) and sprite.overlaps(other, bb1, bb2)
+
+    def get_touching(self, sprite):
+        if not sprite.is_visible():
+            return []
+        bb1 = self._spatial.get_bb(sprite)
+        return [other for other, bb2 in self._spatial.query(sprite)
+                if other.is_visible() and sprite.overlaps(other, bb1, bb2)]
+
+    def get_transform_cache(self):
+        return self._transform_cache
+
+    def load_image(self, costume_info):
+        start = time.perf_counter()
+        try:
+            return self._images.load(costume_info)
+        finally:
+            self._frame_timer.add("decode", time.perf_counter() - start)
+
+    def prefetch_image(self, costume_info):
+        if self._prefetch_costumes:
+            self._images.prefetch([costume_info], min_batch=1)
         
-    def _load_project(self):
+    def _load_project(self, proj_filename):
+        if self._parse_cache is not None:
+            self._parse_key = parse_key(proj_filename)
+            data = self._parse_cache.get(self._parse_key)
+            if data is not None:
+                try:
+                    return pickle.loads(data)
+                except Exception:
+                    # A damaged entry is parsed again and replaced
+                    pass
+
         proj_file = self._zip_file.open("project.json", "r")
         proj_json = proj_file.read().decode("utf-8")
-        return json.loads(proj_json)
+        return json.loads(proj_json), None
+
+    def get_parsed(self, name):
+        if self._parsed is None:
+            return None
+        return self._parsed[name]
+
+    def _save_parsed(self):
+        # The blocks are cached parsed, and are not needed once parsed
+        if self._parse_key is None or self._parsed is not None:
+            return
+
+        targets = [self._stage] + list(self._sprites.values())
+        parsed = {target.name: target.get_parsed() for target in targets}
+        proj = dict(self._proj, targets=[dict(target, blocks={})
+                                         for target in self._proj["targets"]])
+        # One pickle, so that sprites keep sharing the stage's variables
+        self._parse_cache.put(self._parse_key,
+                              pickle.dumps((proj, parsed), pickle.HIGHEST_PROTOCOL))
+        self._parse_cache.trim()
 
     def _load_stage(self):
         stage = None
@@ -361,91 +600,408 @@ class ScratchEnv:
                     except ImportError:
                         pass
                 sprite = Sprite(self, target, self._stage)
-                sb.register_scratch_tasks(sprite)
+                if not self._load_compiled_sprite(name):
+                    sb.register_scratch_tasks(sprite)
                 sprites[name] = sprite
 
         return sprites
 
+    def _load_compiled_sprite(self, name):
+        if self._compiled_package is None:
+            return False
+
+        try:
+            importlib.import_module(self._compiled_package + "." + name)
+        except ImportError:
+            return False
+
+        return True
+
     def draw(self, screen):
         self._stage.draw(screen)
-        sprites = self._sprites.values()
-        for sprite in sorted(sprites, key=lambda s: s.order):
+        for sprite in self._layers.get_sprites():
             sprite.draw(screen)
 
+    def get_layers(self):
+        return self._layers
+
     def get_sprite_by_name(self, name):
         return self._sprites[name]
 
-    def _broadcast(self, message):
-        hat = sb.HatReceived(message)
-        return sb.activate_hats(hat, None, self)
+    def get_sprites(self):
+        return list(self._sprites.values())
+
+    def post_event(self, hat, data=None):
+        return self._events.post(hat, data)
+
+    def deliver_events(self):
+        return self._events.deliver(self)
 
     def broadcast(self, message):
-        self._broadcast(message)
+        return self.post_event(sb.HatReceived(message))
 
     def broadcast_and_wait(self, message):
-        activated = self._broadcast(message)
+        self.broadcast(message).wait()
 
-        # Wait for all activated threads to complete
-        for thread in activated:
-            thread.join()
+    def stop_all(self):
+        # Ends the run at the end of the frame
+        self._stopped = True
 
     def dump_blocks(self):
         for sprite in self._sprites:
             print("\n\n<<{}>>\n\n".format(sprite))
             self._sprites[sprite].dump_blocks()
 
-    def run(self):
+    def _draw_overlay(self, screen):
+        if self._overlay_font is None:
+            self._overlay_font = pygame.font.Font(None, 18)
+
+        p50, p95, p99 = self._frame_timer.percentiles(50, 95, 99)
+        text = "frame ms p50 {:.1f}  p95 {:.1f}  p99 {:.1f}".format(
+            p50 * 1000, p95 * 1000, p99 * 1000)
+        label = self._overlay_font.render(text, True, (0xFF, 0xFF, 0xFF), (0, 0, 0))
+        rect = screen.blit(label, (4, 4))
+
+        # Paint over the overlay on the next frame
+        self._renderer.mark_rect(rect)
+        return rect
+
+    def _render(self, screen, overlay=False):
+        timer = self._frame_timer
+        update = self._renderer.render(screen, self._stage, self._layers.get_sprites())
+        if overlay:
+            rect = self._draw_overlay(screen)
+            if update is not None:
+                update.append(rect)
+        timer.mark("draw")
+
+        if update is None:
+            pygame.display.flip()
+        elif update:
+            pygame.display.update(update)
+        timer.mark("flip")
+
+    def _running_scripts(self):
+        counts = Counter(str(task) for task in sb.running_tasks())
+        return [name if count == 1 else "{} x{}".format(name, count)
+                for name, count in counts.items()]
+
+    def _make_frame_timer(self, trace=None):
+        return FrameTimer(1.0 / self._pacing.fps, trace=trace is not None,
+                          work_time=self._pacing.work_time)
+
+    def _end_run(self, trace, recorder=None, frames=0):
+        if trace is not None:
+            self._frame_timer.write_trace(trace)
+        if recorder is not None:
+            recorder.close(frames)
+
+    def run(self, overlay=False, trace=None, record=None):
         pygame.key.set_repeat(10)
 
         clock = pygame.time.Clock()
-        screen = pygame.display.set_mode((480, 360))
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        timer = self._frame_timer = self._make_frame_timer(trace)
 
-        flag_clicked = sb.HatFlagClicked()
-        sb.activate_hats(flag_clicked, None, self)
+        recorder = None
+        if record is not None:
+            seed = random.randrange(1 << 32)
+            random.seed(seed)
+            recorder = Recorder(record, seed, self._pacing.fps)
 
-        while True:
-            screen.fill((0xFF, 0xFF, 0xFF))
-            self.draw(screen)
-            pygame.display.flip()
+        # Events posted during a frame are delivered at the start of the
+        # next one, which is the frame they are recorded for.
+        nframes = 0
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    sys.exit(0)
-                elif event.type == pygame.KEYDOWN:
-                    try:
-                        key_pressed = sb.HatKeyPressed.from_code(event.key)
-                        sb.activate_hats(key_pressed, None, self)
-                    except ValueError:
-                        pass
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    x, y = pygame.mouse.get_pos()
-                    x, y = pygame_to_scratch_coord(x, y)
-                    sprite_clicked = sb.HatSpriteClicked()
-                    sb.activate_hats(sprite_clicked, (x, y), self)
+        def post_input(hat, data=None):
+            self.post_event(hat, data)
+            if recorder is not None:
+                recorder.record(nframes, hat, data)
 
-            clock.tick(40)
+        post_input(sb.HatFlagClicked())
+
+        # The recording is closed however the run ends
+        try:
+            while not self._stopped:
+                timer.begin()
+                self.deliver_events()
+                timer.mark("hats")
+                if self._scheduler is not None:
+                    self._scheduler.run_frame()
+                timer.mark("scripts")
+
+                self._render(screen, overlay)
+                nframes += 1
+
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        sys.exit(0)
+                    elif event.type == pygame.VIDEOEXPOSE:
+                        self._renderer.invalidate()
+                    elif event.type == pygame.KEYDOWN:
+                        post_input(sb.HatKeyPressed.from_code(event.key))
+                    elif event.type == pygame.MOUSEBUTTONDOWN:
+                        x, y = pygame.mouse.get_pos()
+                        x, y = pygame_to_scratch_coord(x, y)
+                        post_input(sb.HatSpriteClicked(), (x, y))
+                timer.mark("events")
+
+                timer.end(self._running_scripts)
+                clock.tick(self._pacing.fps)
+        finally:
+            self._end_run(trace, recorder, nframes)
+
+    def run_headless(self, frames=None, seconds=None, trace=None, replay=None):
+        # Time as seen by the scripts advances by exactly one frame per
+        # iteration, however long the frame really took.
+        clock = sb.VirtualClock()
+        sb.clock = clock
+        frame_time = 1.0 / self._pacing.fps
+
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        timer = self._frame_timer = self._make_frame_timer(trace)
+        start = time.perf_counter()
+
+        if replay is None:
+            self.post_event(sb.HatFlagClicked())
+        else:
+            random.seed(replay.seed)
+            if frames is None and seconds is None:
+                frames = replay.frames
+
+        # Counted in frames, as adding up frame times drifts
+        if seconds is not None:
+            limit = round(seconds * self._pacing.fps)
+            frames = limit if frames is None else min(frames, limit)
+
+        nframes = 0
+        while not self._stopped and (frames is None or nframes < frames):
+            timer.begin()
+            if replay is not None:
+                for hat, data in replay.get_events(nframes):
+                    self.post_event(hat, data)
+            self.deliver_events()
+            timer.mark("hats")
+            if self._scheduler is not None:
+                self._scheduler.run_frame()
+            timer.mark("scripts")
+
+            self._render(screen)
+            pygame.event.pump()
+            timer.mark("events")
+            timer.end(self._running_scripts)
+
+            clock.advance(frame_time)
+            nframes += 1
+
+        self._end_run(trace)
+        p50, p95, p99 = timer.percentiles(50, 95, 99)
+        return {
+            "frames": nframes,
+            "blocks": self._stats.blocks if self._stats is not None else None,
+            "wall_time": time.perf_counter() - start,
+            "transform_hits": self._transform_cache.hits,
+            "transform_misses": self._transform_cache.misses,
+            "transform_bytes": self._transform_cache.get_bytes(),
+            "frame_p50": p50,
+            "frame_p95": p95,
+            "frame_p99": p99,
+        }
+
+
+def print_report(report):
+    wall_time = report["wall_time"]
+    print("frames:    {}".format(report["frames"]))
+    print("blocks:    {}".format(report["blocks"]))
+    print("wall time: {:.3f} s".format(wall_time))
+    if wall_time > 0:
+        print("frames/s:  {:.1f}".format(report["frames"] / wall_time))
+        print("blocks/s:  {:.1f}".format(report["blocks"] / wall_time))
+    print("transform cache: {} hits, {} misses, {:.1f} MB".format(
+        report["transform_hits"], report["transform_misses"],
+        report["transform_bytes"] / (1 << 20)))
+    print("frame ms:  p50 {:.2f}, p95 {:.2f}, p99 {:.2f}".format(
+        report["frame_p50"] * 1000, report["frame_p95"] * 1000,
+        report["frame_p99"] * 1000))
+
+
+def print_profile(profiler, top):
+    by_opcode = {}
+    for (sprite, script, opcode), (calls, total, own) in profiler.ops.items():
+        entry = by_opcode.setdefault(opcode, [0, 0.0, 0.0])
+        entry[0] += calls
+        entry[1] += total
+        entry[2] += own
+
+    header = "{:>10} {:>10} {:>9}  {}".format("self ms", "total ms", "calls", "{}")
+    row = "{:10.2f} {:10.2f} {:9d}  {}"
+
+    print()
+    print(header.format("opcode"))
+    for opcode, (calls, total, own) in sorted(by_opcode.items(),
+                                              key=lambda item: -item[1][2]):
+        print(row.format(own * 1000, total * 1000, calls, opcode))
+
+    print()
+    print(header.format("sprite / script / opcode"))
+    ops = sorted(profiler.ops.items(), key=lambda item: -item[1][2])
+    for (sprite, script, opcode), (calls, total, own) in ops[:top]:
+        print(row.format(own * 1000, total * 1000, calls,
+                         "{} / {} / {}".format(sprite, script, opcode)))
+
+
+def run_batch_project(filename, frames, seconds, pacing_mode):
+    # Runs in a worker process of its own. Speech is in the report, so
+    # printing it as well is not needed.
+    sys.stdout = open(os.devnull, "w")
+    sb.tasks_by_hat.clear()
+    pygame.init()
+
+    start = time.perf_counter()
+    env = ScratchEnv(filename, None, None,
+                     pacing=sb.Pacing(pacing_mode, FPS), stats=Stats(), jobs=1)
+    load_time = time.perf_counter() - start
+
+    report = env.run_headless(frames, seconds)
+    report["load_time"] = load_time
+    report["variables"] = env.get_variable_values()
+    report["speech"] = env.get_speech()
+    return report
+
+
+def batch(args):
+    filenames = find_projects(args.project)
+    fobj = open(args.output, "w") if args.output is not None else sys.stdout
+
+    counts = Counter()
+    try:
+        for report in run_batch(run_batch_project, filenames,
+                                (args.frames, args.seconds, args.pacing),
+                                args.workers, args.timeout):
+            fobj.write(json.dumps(report) + "\n")
+            fobj.flush()
+            counts[report["status"]] += 1
+    finally:
+        if fobj is not sys.stdout:
+            fobj.close()
+
+    print("{} projects: {}".format(len(filenames), ", ".join(
+        "{} {}".format(count, status) for status, count in sorted(counts.items()))),
+          file=sys.stderr)
 
 
 def main():
-    if len(sys.argv) not in [3, 4]:
-        print("scratch2py <cmd> <scratch-project> [<code-package>]")
-        exit(1)
+    parser = argparse.ArgumentParser(prog="scratch2py")
+    parser.add_argument("cmd", choices=["run", "headless", "profile", "batch",
+                                        "compile", "dump-blocks"])
+    parser.add_argument("project", help="Scratch project (.sb3), or for batch "
+                        "a directory or glob pattern of projects")
+    parser.add_argument("package", nargs="?", help="Python code package")
+    parser.add_argument("--threads", action="store_true",
+                        help="run each script in its own thread")
+    parser.add_argument("--pacing", choices=sb.Pacing.MODES, default="scratch",
+                        help="scratch: one loop iteration per frame, "
+                        "budget: run scripts for part of each frame, "
+                        "turbo: run scripts for the whole frame")
+    parser.add_argument("--budget", type=float, metavar="MS",
+                        help="script time per frame in budget mode")
+    parser.add_argument("--frames", type=int,
+                        help="number of frames to run in headless mode")
+    parser.add_argument("--seconds", type=float,
+                        help="project time to run in headless mode")
+    parser.add_argument("--overlay", action="store_true",
+                        help="show frame time percentiles on screen")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write per frame timings to a .csv or .json file")
+    parser.add_argument("--folded", metavar="FILE",
+                        help="folded stacks for flamegraph.pl written by profile "
+                        "(default: <project>.folded)")
+    parser.add_argument("--top", type=int, default=20,
+                        help="rows of the per script table printed by profile")
+    parser.add_argument("--workers", type=int,
+                        help="projects run at once by batch (default: one per CPU)")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds after which batch stops a project")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record input events and the random seed of a run")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="feed a recorded run to headless or profile "
+                        "(default length: the recorded frames)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="JSON lines report written by batch (default: stdout)")
+    parser.add_argument("--jobs", type=int,
+                        help="processes used to decode costumes (default: one per CPU)")
+    parser.add_argument("--prefetch-costumes", action="store_true",
+                        help="decode the next costume in the background")
+    parser.add_argument("--angle-step", type=float, default=1.0, metavar="DEG",
+                        help="round sprite directions to this step when drawing")
+    parser.add_argument("--scale-step", type=float, default=1.0, metavar="PCT",
+                        help="round sprite sizes to this step when drawing")
+    parser.add_argument("--transform-cache-mb", type=int, default=64,
+                        help="memory for scaled and rotated costumes")
+    parser.add_argument("--costume-cache-mb", type=int, default=8,
+                        help="memory for scaled and rotated versions of one costume")
+    args = parser.parse_args()
+
+    if args.cmd == "compile":
+        print(codegen.compile_project(args.project))
+        return
+
+    if args.record is not None and args.cmd != "run":
+        parser.error("--record only works with run")
+    if args.replay is not None and args.cmd not in ("headless", "profile"):
+        parser.error("--replay only works with headless and profile")
+
+    stats = None
+    if args.cmd in ("headless", "profile", "batch"):
+        if args.frames is None and args.seconds is None and args.replay is None:
+            parser.error("{} needs --frames or --seconds".format(args.cmd))
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+        stats = Profiler() if args.cmd == "profile" else Stats()
+
+    if args.cmd == "batch":
+        batch(args)
+        return
 
     pygame.init()
-        
-    cmd = sys.argv[1]
-    sb3_filename = sys.argv[2]
-    py_package = None
-    if len(sys.argv) == 4:
-        py_package = sys.argv[3]
-        
-    env = ScratchEnv(sb3_filename, py_package)
 
-    if cmd == "run":
-        env.run()
-    elif cmd == "dump-blocks":
+    budget = args.budget / 1000 if args.budget is not None else None
+    pacing = sb.Pacing(args.pacing, FPS, budget)
+
+    transform_cache = TransformCache(args.transform_cache_mb << 20,
+                                     args.costume_cache_mb << 20,
+                                     args.angle_step, args.scale_step)
+
+    # Compiled modules bypass the blocks, so headless and profile would
+    # have no blocks to count or time.
+    compiled_package = None
+    if args.cmd == "run":
+        compiled_package = codegen.load_compiled(args.project)
+    replay = Replay(args.replay) if args.replay is not None else None
+    env = ScratchEnv(args.project, args.package, compiled_package,
+                     threaded=args.threads, pacing=pacing, stats=stats,
+                     jobs=args.jobs, prefetch_costumes=args.prefetch_costumes,
+                     transform_cache=transform_cache)
+
+    if args.cmd == "run":
+        env.run(args.overlay, args.trace, args.record)
+    elif args.cmd == "headless":
+        print_report(env.run_headless(args.frames, args.seconds, args.trace, replay))
+    elif args.cmd == "profile":
+        print_report(env.run_headless(args.frames, args.seconds, args.trace, replay))
+        print_profile(stats, args.top)
+
+        folded = args.folded
+        if folded is None:
+            folded = os.path.splitext(os.path.basename(args.project))[0] + ".folded"
+        with open(folded, "w") as fobj:
+            stats.write_folded(fobj)
+        print()
+        print("folded stacks written to {}".format(folded))
+    elif args.cmd == "dump-blocks":
         env.dump_blocks()
 
 
-main()
-
+if __name__ == "__main__":
+    main()
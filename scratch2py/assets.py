@@ -0,0 +1,117 @@
+import io
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+import cairosvg
+import pygame
+
+from .cache import get_cache_dir, LRUFileCache
+
+IMAGE_FORMATS = ("png", "svg", "jpg")
+
+RASTER_CACHE_MB = int(os.environ.get("SCRATCH2PY_RASTER_CACHE_MB", 256))
+
+# Below this many images, starting worker processes costs more than
+# decoding the images in place.
+MIN_POOL_IMAGES = 8
+
+
+def decode_image(fmt, data):
+    # Returns the rasterized PNG as well for SVGs, so that it can be
+    # kept in the raster cache.
+    png = None
+    if fmt == "svg":
+        data = png = cairosvg.svg2png(bytestring=data)
+        fmt = "png"
+    elif fmt not in IMAGE_FORMATS:
+        raise ValueError("Unsupported dataFormat {}".format(fmt))
+
+    surface = pygame.image.load(io.BytesIO(data), "costume." + fmt)
+    return surface.get_size(), pygame.image.tobytes(surface, "RGBA"), png
+
+
+def get_raster_cache():
+    if RASTER_CACHE_MB <= 0:
+        return None
+    return LRUFileCache(get_cache_dir("rasters"), RASTER_CACHE_MB << 20)
+
+
+def raster_key(costume_info):
+    return "{}-{}.png".format(costume_info["md5ext"].rsplit(".", 1)[0],
+                              costume_info.get("bitmapResolution", 1))
+
+
+class ImageLoader:
+    def __init__(self, zip_file, jobs=None, raster_cache=None):
+        self._zip_file = zip_file
+        self._jobs = jobs if jobs is not None else os.cpu_count()
+        self._raster_cache = raster_cache
+        self._pool = None
+        self._pending = {}
+        self._surfaces = {}
+        self._lock = threading.Lock()
+
+    def _read(self, costume_info):
+        fmt = costume_info["dataFormat"]
+        if fmt == "svg" and self._raster_cache is not None:
+            png = self._raster_cache.get(raster_key(costume_info))
+            if png is not None:
+                return "png", png
+
+        return fmt, self._zip_file.read(costume_info["md5ext"])
+
+    def prefetch(self, costume_infos, min_batch=MIN_POOL_IMAGES):
+        with self._lock:
+            todo = {}
+            for ci in costume_infos:
+                md5ext = ci["md5ext"]
+                if md5ext not in self._surfaces and md5ext not in self._pending:
+                    todo[md5ext] = ci
+
+            if self._jobs <= 1 or len(todo) < min_batch:
+                return
+
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self._jobs)
+
+            for md5ext, ci in todo.items():
+                fmt, data = self._read(ci)
+                self._pending[md5ext] = self._pool.submit(decode_image, fmt, data)
+
+    def load(self, costume_info):
+        with self._lock:
+            return self._load(costume_info)
+
+    def _load(self, costume_info):
+        md5ext = costume_info["md5ext"]
+        surface = self._surfaces.get(md5ext)
+        if surface is not None:
+            return surface
+
+        future = self._pending.pop(md5ext, None)
+        if future is not None:
+            size, rgba, png = future.result()
+        else:
+            size, rgba, png = decode_image(*self._read(costume_info))
+
+        if png is not None and self._raster_cache is not None:
+            self._raster_cache.put(raster_key(costume_info), png)
+
+        surface = pygame.image.frombytes(rgba, size, "RGBA")
+        self._surfaces[md5ext] = surface
+        return surface
+
+    def close(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def trim_cache(self):
+        if self._raster_cache is not None:
+            self._raster_cache.trim()
@@ -0,0 +1,70 @@
+import os
+import glob
+import time
+import multiprocessing
+
+from multiprocessing.connection import wait
+
+
+def find_projects(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.sb3")
+    return sorted(glob.glob(pattern))
+
+
+def _work(func, args, conn):
+    try:
+        result = {"status": "ok"}
+        result.update(func(*args))
+    except Exception as exc:
+        result = {"status": "error", "error": "{}: {}".format(type(exc).__name__, exc)}
+
+    conn.send(result)
+    conn.close()
+
+
+def run_batch(func, filenames, args=(), workers=None, timeout=None):
+    # Every project gets a process of its own, unlike in a pool, so
+    # that one that hangs can be killed without stopping the others.
+    # Yields the result of each project as it finishes.
+    workers = workers or os.cpu_count()
+    pending = list(reversed(filenames))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < workers:
+            filename = pending.pop()
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_work, daemon=True,
+                                              args=(func, (filename,) + tuple(args),
+                                                    send_conn))
+            process.start()
+            send_conn.close()
+            running[recv_conn] = (process, filename, time.monotonic())
+
+        for conn in wait(list(running), timeout=0.1):
+            process, filename, start = running.pop(conn)
+            try:
+                result = conn.recv()
+            except EOFError:
+                process.join()
+                result = {"status": "crashed", "exitcode": process.exitcode}
+            conn.close()
+            process.join()
+
+            report = {"project": filename}
+            report.update(result)
+            report["elapsed"] = time.monotonic() - start
+            yield report
+
+        if timeout is None:
+            continue
+
+        now = time.monotonic()
+        for conn, (process, filename, start) in list(running.items()):
+            if now - start > timeout:
+                del running[conn]
+                process.kill()
+                process.join()
+                conn.close()
+                yield {"project": filename, "status": "timeout", "elapsed": now - start}
@@ -0,0 +1,75 @@
+import os
+import hashlib
+
+
+def get_cache_dir(*parts):
+    root = os.environ.get("SCRATCH2PY_CACHE")
+    if root is None:
+        xdg = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        root = os.path.join(xdg, "scratch2py")
+
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(1 << 16), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class LRUFileCache:
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fobj:
+                data = fobj.read()
+        except FileNotFoundError:
+            return None
+
+        # The modification time doubles as the last use time
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as fobj:
+            fobj.write(data)
+        os.replace(tmp_path, path)
+
+    def trim(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self._directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
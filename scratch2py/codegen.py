@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import math
+import inspect
+import keyword
+import shutil
+import tempfile
+
+from zipfile import ZipFile
+
+from . import sb
+from .cache import get_cache_dir, file_hash
+from .vm import VM, Parser, Script, Literal, Variable, Color
+from .vm import STACK_INPUTS, WATCHED_INPUTS, get_dependencies
+
+# Generated modules call into sb and vm, so a change to their source,
+# or to this file, makes new ones.
+CODEGEN_VERSION = "".join(file_hash(path)[:8]
+                          for path in (sb.__file__, inspect.getfile(VM), __file__))
+
+VARIABLE_FIELDS = ("variable", "list")
+
+EXPR_TEMPLATES = {
+    "operator_add": "(float({num1}) + float({num2}))",
+    "operator_subtract": "(float({num1}) - float({num2}))",
+    "operator_multiply": "(float({num1}) * float({num2}))",
+    "operator_divide": "(float({num1}) / float({num2}))",
+    "operator_mod": "({num1} % {num2})",
+    "operator_gt": "(compare({operand1}, {operand2}) > 0)",
+    "operator_lt": "(compare({operand1}, {operand2}) < 0)",
+    "operator_equals": "(compare({operand1}, {operand2}) == 0)",
+    "operator_and": "({operand1} and {operand2})",
+    "operator_or": "({operand1} or {operand2})",
+    "operator_not": "(not {operand})",
+    "operator_join": "({string1} + {string2})",
+    "operator_length": "len({string})",
+    "motion_xposition": "sprite.x",
+    "motion_yposition": "sprite.y",
+}
+
+STMT_TEMPLATES = {
+    "data_setvariableto": "{variable}.set_value({value})",
+    "data_changevariableby": "{variable}.set_value(to_number({variable}.get_value()) + to_number({value}))",
+    "motion_movesteps": "sprite.move({steps})",
+    "motion_changexby": "sprite.x += int({dx})",
+    "motion_changeyby": "sprite.y += int({dy})",
+    "motion_setx": "sprite.x = int({x})",
+    "motion_sety": "sprite.y = int({y})",
+    "motion_pointindirection": "sprite.point_in_direction({direction})",
+    "motion_ifonedgebounce": "sprite.if_on_edge_bounce()",
+    "looks_say": "sprite.say({message})",
+    "looks_nextcostume": "sprite.next_costume()",
+}
+
+MODULE_HEADER = """\
+# Generated by scratch2py from {} -- do not edit.
+from scratch2py import sb
+from scratch2py.vm import Color, compare, to_number
+"""
+
+
+class SpriteCodegen:
+    def __init__(self, parser):
+        self._parser = parser
+        self._lines = []
+        self._level = 0
+        self._vars = {}
+        self._nsubs = 0
+        self._yields = False
+
+    def _emit(self, line):
+        self._lines.append("    " * self._level + line)
+
+    def _emit_yield(self, line="yield"):
+        self._emit(line)
+        self._yields = True
+
+    def _emit_generator_body(self, script):
+        # Every stack must be a generator, so that the scheduler can
+        # step it even when it never yields.
+        yields = self._yields
+        self._yields = False
+        self._emit_stack(script)
+        if not self._yields:
+            self._emit("yield from ()")
+        self._yields = yields
+
+    def generate(self, source_name):
+        self._lines = [MODULE_HEADER.format(source_name).rstrip("\n")]
+        for i, (script, hat) in enumerate(self._parser.get_hats()):
+            self._emit_hat(i, script, hat)
+
+        return "\n".join(self._lines) + "\n"
+
+    def _decorator(self, hat):
+        if isinstance(hat, sb.HatFlagClicked):
+            return "@sb.when_flag_clicked"
+        elif isinstance(hat, sb.HatKeyPressed):
+            return "@sb.when_key_pressed({!r})".format(hat.get_name())
+        elif isinstance(hat, sb.HatReceived):
+            return "@sb.when_received({!r})".format(hat.get_string())
+        else:
+            raise ValueError("Unsupported hat {}".format(type(hat).__name__))
+
+    def _emit_hat(self, index, script, hat):
+        self._emit("")
+        self._emit("")
+        self._emit(self._decorator(hat))
+        self._emit("def script_{}(sprite, env):".format(index))
+        self._level += 1
+        self._vars = {}
+        self._emit("vm = sprite.get_vm()")
+        header = len(self._lines)
+        self._emit_generator_body(script)
+
+        bindings = ["    " * self._level + "{} = vm.get_{}({!r})".format(ref, kind, name)
+                    for (kind, name), ref in self._vars.items()]
+        self._lines[header:header] = bindings
+        self._level -= 1
+
+    def _blocks(self, script):
+        return [block for block in script.get_blocks()
+                if not block.get_opcode().startswith("event_when")]
+
+    def _emit_stack(self, script):
+        blocks = self._blocks(script) if script is not None else []
+        if not blocks:
+            self._emit("pass")
+
+        for block in blocks:
+            self._emit_statement(block)
+
+    def _emit_body(self, script, loop=False):
+        self._level += 1
+        self._emit_stack(script)
+        if loop:
+            self._emit_yield()
+        self._level -= 1
+
+    def _emit_statement(self, block):
+        opcode = block.get_opcode()
+        args = block.get_args()
+
+        if opcode == "control_forever":
+            self._emit("while True:")
+            self._emit_body(args.get("substack"), loop=True)
+        elif opcode == "control_repeat":
+            self._emit("for _ in range({}):".format(self._expr(args.get("times"))))
+            self._emit_body(args.get("substack"), loop=True)
+        elif opcode == "control_if":
+            self._emit("if {}:".format(self._expr(args.get("condition"))))
+            self._emit_body(args.get("substack"))
+        elif opcode in STMT_TEMPLATES:
+            self._emit(STMT_TEMPLATES[opcode].format(**self._render(args)))
+        elif self._is_generator_op(opcode):
+            self._emit_yield("yield from {}".format(self._call(block)))
+        else:
+            self._emit(self._call(block))
+
+    def _is_generator_op(self, opcode):
+        return inspect.isgeneratorfunction(getattr(VM, "op_" + opcode, None))
+
+    def _var_ref(self, kind, variable):
+        key = (kind, variable.get_name())
+        if key not in self._vars:
+            self._vars[key] = "var_{}".format(len(self._vars))
+        return self._vars[key]
+
+    def _render(self, args):
+        rendered = {}
+        for kw, arg in args.items():
+            if kw in VARIABLE_FIELDS:
+                rendered[kw] = self._var_ref(kw, arg)
+            else:
+                rendered[kw] = self._expr(arg)
+        return rendered
+
+    def _expr(self, arg):
+        if arg is None:
+            return "None"
+        elif isinstance(arg, Literal):
+            value = arg.get_value()
+            if isinstance(value, float) and not math.isfinite(value):
+                return "float({!r})".format(str(value))
+            return repr(value)
+        elif isinstance(arg, Variable):
+            return "{}.get_value()".format(self._var_ref("variable", arg))
+        elif isinstance(arg, Color):
+            return "Color({!r})".format(arg.get_string())
+        elif isinstance(arg, Script):
+            blocks = self._blocks(arg)
+            if len(blocks) == 1:
+                return self._block_expr(blocks[0])
+            return "{}()".format(self._emit_sub(arg, returns=True))
+        else:
+            return repr(arg)
+
+    def _block_expr(self, block):
+        opcode = block.get_opcode()
+        if opcode in EXPR_TEMPLATES:
+            return EXPR_TEMPLATES[opcode].format(**self._render(block.get_args()))
+        return self._call(block)
+
+    def _thunk(self, kw, arg):
+        if kw in VARIABLE_FIELDS:
+            return self._var_ref(kw, arg)
+        elif arg is None or isinstance(arg, str):
+            return repr(arg)
+        elif isinstance(arg, Script) and kw in STACK_INPUTS:
+            return self._emit_sub(arg)
+        else:
+            return "lambda: {}".format(self._expr(arg))
+
+    def _call(self, block):
+        kwargs = []
+        for kw, arg in block.get_args().items():
+            name = kw + "_" if keyword.iskeyword(kw) else kw
+            kwargs.append("{}={}".format(name, self._thunk(kw, arg)))
+
+        watched = WATCHED_INPUTS.get(block.get_opcode())
+        if watched is not None:
+            variables = get_dependencies(block.get_args().get(watched))
+            if variables is not None:
+                refs = [self._var_ref("variable", v)
+                        for v in sorted(variables, key=lambda v: v.get_name())]
+                kwargs.append("watch=[{}]".format(", ".join(refs)))
+
+        return "vm.op_{}({})".format(block.get_opcode(), ", ".join(kwargs))
+
+    def _emit_sub(self, script, returns=False):
+        name = "_sub_{}".format(self._nsubs)
+        self._nsubs += 1
+
+        blocks = self._blocks(script)
+        self._emit("def {}():".format(name))
+        self._level += 1
+        if returns and blocks:
+            yields = self._yields
+            for block in blocks[:-1]:
+                self._emit_statement(block)
+            self._emit("return {}".format(self._block_expr(blocks[-1])))
+            self._yields = yields
+        else:
+            self._emit_generator_body(script)
+        self._level -= 1
+
+        return name
+
+
+def _is_module_name(name):
+    return bool(name) and not any(ch in name for ch in "./\\") and not name.startswith("_")
+
+
+def get_package_name(proj_filename):
+    return "sb3_{}_v{}".format(file_hash(proj_filename), CODEGEN_VERSION)
+
+
+def _write_package(proj_filename, pkg_dir):
+    with ZipFile(proj_filename) as zip_file:
+        proj = json.loads(zip_file.read("project.json").decode("utf-8"))
+
+    targets = proj["targets"]
+    stage = Parser([t for t in targets if t["isStage"]][0], None)
+    source_name = os.path.basename(proj_filename)
+
+    with open(os.path.join(pkg_dir, "__init__.py"), "w") as fobj:
+        fobj.write("# Generated by scratch2py from {} -- do not edit.\n".format(source_name))
+
+    for target in targets:
+        name = target["name"]
+        if target["isStage"] or not _is_module_name(name):
+            continue
+
+        parser = Parser(target, stage.get_variables())
+        source = SpriteCodegen(parser).generate(source_name)
+        with open(os.path.join(pkg_dir, name + ".py"), "w") as fobj:
+            fobj.write(source)
+
+
+def compile_project(proj_filename):
+    root = get_cache_dir("compiled")
+    pkg_dir = os.path.join(root, get_package_name(proj_filename))
+
+    if not os.path.isdir(pkg_dir):
+        tmp_dir = tempfile.mkdtemp(dir=root)
+        try:
+            _write_package(proj_filename, tmp_dir)
+            os.rename(tmp_dir, pkg_dir)
+        except OSError:
+            # Another process compiled the same project first
+            shutil.rmtree(tmp_dir)
+            if not os.path.isdir(pkg_dir):
+                raise
+        except Exception:
+            shutil.rmtree(tmp_dir)
+            raise
+
+    return pkg_dir
+
+
+def load_compiled(proj_filename):
+    root = get_cache_dir("compiled")
+    name = get_package_name(proj_filename)
+    if not os.path.isdir(os.path.join(root, name)):
+        return None
+
+    if root not in sys.path:
+        sys.path.append(root)
+
+    return name
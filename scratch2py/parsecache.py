@@ -0,0 +1,20 @@
+import os
+
+from . import sb
+from . import vm
+from .cache import get_cache_dir, file_hash, LRUFileCache
+
+# The cache holds instances of the classes in these modules, so any
+# change to their source starts a new one.
+PARSE_CACHE_VERSION = "".join(file_hash(module.__file__)[:8] for module in (sb, vm))
+PARSE_CACHE_MB = int(os.environ.get("SCRATCH2PY_PARSE_CACHE_MB", 64))
+
+
+def get_parse_cache():
+    if PARSE_CACHE_MB <= 0:
+        return None
+    return LRUFileCache(get_cache_dir("parsed"), PARSE_CACHE_MB << 20)
+
+
+def parse_key(proj_filename):
+    return "{}-v{}.pickle".format(file_hash(proj_filename), PARSE_CACHE_VERSION)
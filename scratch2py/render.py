@@ -0,0 +1,194 @@
+import threading
+
+from collections import OrderedDict
+
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+def mask_bytes(mask):
+    width, height = mask.get_size()
+    return (width * height + 7) // 8
+
+
+class TransformCache:
+    def __init__(self, max_bytes=64 << 20, costume_max_bytes=8 << 20,
+                 angle_step=1.0, scale_step=1.0):
+        self._max_bytes = max_bytes
+        self._costume_max_bytes = costume_max_bytes
+        self._angle_step = angle_step
+        self._scale_step = scale_step
+
+        # Least recently used first, both overall and per costume
+        self._entries = OrderedDict()
+        self._by_owner = {}
+        self._owner_bytes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, size, direction):
+        if self._scale_step:
+            size = round(size / self._scale_step) * self._scale_step
+        if self._angle_step:
+            direction = round(direction / self._angle_step) * self._angle_step
+        return size, direction % 360
+
+    def get(self, owner, key):
+        with self._lock:
+            entry = self._entries.get((owner, key))
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end((owner, key))
+            self._by_owner[owner].move_to_end(key)
+            return entry[0]
+
+    def put(self, owner, key, value, nbytes):
+        with self._lock:
+            if (owner, key) in self._entries:
+                self._remove(owner, key)
+
+            self._entries[(owner, key)] = (value, nbytes)
+            self._by_owner.setdefault(owner, OrderedDict())[key] = nbytes
+            self._owner_bytes[owner] = self._owner_bytes.get(owner, 0) + nbytes
+            self._bytes += nbytes
+
+            owned = self._by_owner[owner]
+            while self._owner_bytes[owner] > self._costume_max_bytes and len(owned) > 1:
+                self._remove(owner, next(iter(owned)))
+
+            while self._bytes > self._max_bytes and len(self._entries) > 1:
+                self._remove(*next(iter(self._entries)))
+
+    def _remove(self, owner, key):
+        value, nbytes = self._entries.pop((owner, key))
+        owned = self._by_owner[owner]
+        del owned[key]
+        self._owner_bytes[owner] -= nbytes
+        self._bytes -= nbytes
+        if not owned:
+            del self._by_owner[owner]
+            del self._owner_bytes[owner]
+
+    def get_bytes(self):
+        return self._bytes
+
+
+class DirtyRenderer:
+    # Above this share of the screen, one full redraw is cheaper than
+    # many clipped ones.
+    FULL_REDRAW_RATIO = 0.5
+
+    def __init__(self, background=(0xFF, 0xFF, 0xFF)):
+        self._background = background
+        self._rects = {}
+        self._changed = set()
+        self._extra = []
+        self._full = True
+
+    def mark(self, target):
+        self._changed.add(target)
+
+    def mark_rect(self, rect):
+        self._extra.append(rect)
+
+    def invalidate(self):
+        self._full = True
+
+    def _merge(self, rects):
+        merged = []
+        for rect in rects:
+            i = 0
+            while i < len(merged):
+                if merged[i].colliderect(rect):
+                    rect = rect.union(merged.pop(i))
+                    i = 0
+                else:
+                    i += 1
+            merged.append(rect)
+        return merged
+
+    def _draw_all(self, screen, stage, sprites):
+        screen.fill(self._background)
+        stage.draw(screen)
+        for sprite in sprites:
+            sprite.draw(screen)
+
+    # Returns the areas of the display to update, or None when all of
+    # it has to be flipped.
+    def render(self, screen, stage, sprites):
+        changed, self._changed = self._changed, set()
+        dirty, self._extra = self._extra, []
+
+        if self._full or stage in changed:
+            self._full = False
+            self._draw_all(screen, stage, sprites)
+            self._rects = {sprite: sprite.get_rect() for sprite in sprites}
+            return None
+
+        for sprite in changed:
+            old = self._rects.get(sprite)
+            new = sprite.get_rect()
+            if new is not None:
+                dirty.append(new)
+            if old is not None and old != new:
+                dirty.append(old)
+            self._rects[sprite] = new
+
+        if not dirty:
+            return []
+
+        dirty = self._merge(dirty)
+        area = sum(rect.w * rect.h for rect in dirty)
+        if area > self.FULL_REDRAW_RATIO * screen.get_width() * screen.get_height():
+            self._draw_all(screen, stage, sprites)
+            return None
+
+        for rect in dirty:
+            screen.set_clip(rect)
+            screen.fill(self._background)
+            stage.draw(screen)
+            for sprite in sprites:
+                sprite_rect = self._rects.get(sprite)
+                if sprite_rect is not None and sprite_rect.colliderect(rect):
+                    sprite.draw(screen)
+        screen.set_clip(None)
+
+        return dirty
+
+
+class Layers:
+    def __init__(self, sprites):
+        # Bottom layer first. Changes build a new list, so the renderer
+        # can keep iterating the one it has.
+        self._sprites = sorted(sprites, key=lambda s: s.order)
+        self._renumber()
+
+    def _renumber(self):
+        for i, sprite in enumerate(self._sprites):
+            sprite.order = i
+
+    def _place(self, sprite, index):
+        sprites = [s for s in self._sprites if s is not sprite]
+        index = max(0, min(index, len(sprites)))
+        sprites.insert(index, sprite)
+        self._sprites = sprites
+        self._renumber()
+
+    def get_sprites(self):
+        return self._sprites
+
+    def go_to_front(self, sprite):
+        self._place(sprite, len(self._sprites))
+
+    def go_to_back(self, sprite):
+        self._place(sprite, 0)
+
+    def go_forward(self, sprite, layers):
+        self._place(sprite, sprite.order + layers)
@@ -0,0 +1,74 @@
+import json
+
+from . import sb
+
+REPLAY_VERSION = 1
+
+
+def encode_event(hat, data):
+    if isinstance(hat, sb.HatFlagClicked):
+        return ["flag"]
+    elif isinstance(hat, sb.HatKeyPressed):
+        return ["key", hat.get_name()]
+    elif isinstance(hat, sb.HatSpriteClicked):
+        return ["click", data[0], data[1]]
+    elif isinstance(hat, sb.HatReceived):
+        return ["broadcast", hat.get_string()]
+    else:
+        raise ValueError("Cannot record {!r}".format(hat))
+
+
+def decode_event(event):
+    kind = event[0]
+    if kind == "flag":
+        return sb.HatFlagClicked(), None
+    elif kind == "key":
+        return sb.HatKeyPressed.from_name(event[1]), None
+    elif kind == "click":
+        return sb.HatSpriteClicked(), (event[1], event[2])
+    elif kind == "broadcast":
+        return sb.HatReceived(event[1]), None
+    else:
+        raise ValueError("Unknown recorded event {}".format(kind))
+
+
+class Recorder:
+    # One JSON list per line: a header, then [frame, event...] for each
+    # event by the frame it is delivered in, then ["end", frames].
+    def __init__(self, filename, seed, fps):
+        self._fobj = open(filename, "w")
+        self._write(["scratch2py-replay", REPLAY_VERSION, seed, fps])
+
+    def _write(self, record):
+        self._fobj.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def record(self, frame, hat, data):
+        self._write([frame] + encode_event(hat, data))
+
+    def close(self, frames):
+        self._write(["end", frames])
+        self._fobj.close()
+
+
+class Replay:
+    def __init__(self, filename):
+        self._events = {}
+        self.frames = 0
+
+        with open(filename) as fobj:
+            header = json.loads(fobj.readline())
+            if header[:2] != ["scratch2py-replay", REPLAY_VERSION]:
+                raise ValueError("{} is not a replay file of version {}"
+                                 .format(filename, REPLAY_VERSION))
+            self.seed, self.fps = header[2:4]
+
+            for line in fobj:
+                record = json.loads(line)
+                if record[0] == "end":
+                    self.frames = record[1]
+                    continue
+                self._events.setdefault(record[0], []).append(decode_event(record[1:]))
+                self.frames = max(self.frames, record[0] + 1)
+
+    def get_events(self, frame):
+        return self._events.get(frame, [])
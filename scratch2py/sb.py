@@ -1,36 +1,115 @@
 import string
 import time
+import inspect
 import threading
+import traceback
 
 from threading import Thread
 
+import pygame
+
+from .timers import TimerWheel
+
+# Tasks by hat key, filled in as the project loads
 tasks_by_hat = {}
 
+# When set, generator actions are stepped from the main loop instead
+# of getting a thread of their own.
+scheduler = None
+
+class Clock:
+    def now(self):
+        return time.monotonic()
+
+
+class VirtualClock:
+    def __init__(self):
+        self._now = 0.0
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+
+clock = Clock()
+
+
+class Until:
+    # Yielded by a script waiting for condition() to become true. It is
+    # checked once a frame, and when the variables it reads are known,
+    # also right after one of them changes.
+    def __init__(self, condition, variables=None):
+        self.condition = condition
+        self.variables = variables
+
+    def block(self):
+        while not self.condition():
+            time.sleep(1.0 / pacing.fps)
+
+
+class Stop:
+    # Yielded by a script running a stop block
+    def __init__(self, option):
+        self.option = option
+
+
+class Sleep:
+    # Yielded by a script waiting for the clock to reach deadline
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def block(self):
+        while True:
+            remaining = self.deadline - clock.now()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1.0 / pacing.fps))
+
 class HatBase:
-    def __eq__(self, other):
-        if type(self) != type(other):
-            return False
+    # Activating a running script starts it over, as in Scratch
+    RESTART = False
 
-        return True
+    # Hats are dispatched by key, the hat type and its parameter.
+    def get_key(self):
+        return (type(self), None)
+
+    # Events also activate the hats registered under this key
+    def get_wildcard_key(self):
+        return None
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.get_key() == other.get_key()
 
     def __hash__(self):
-        return hash(0)
+        return hash(self.get_key())
+
+    def __repr__(self):
+        param = self.get_key()[1]
+        if param is None:
+            return "{}()".format(type(self).__name__)
+        return "{}({!r})".format(type(self).__name__, param)
 
     def condition(self, data, env, sprite):
         return True
 
 
 class HatFlagClicked(HatBase):
-    pass
+    RESTART = True
 
 
 class HatKeyPressed(HatBase):
     KEY_NAME_LIST = (["space", "up arrow", "down arrow", "right arrow", "left arrow", "any"] +
                      list(string.ascii_lowercase) + list(string.digits))
 
-    KEY_CODE_LIST = ([0x20, 0x111, 0x112, 0x113, 0x114, 0xFFFF] +
+    # "any" has no key code of its own
+    KEY_CODE_LIST = ([pygame.K_SPACE, pygame.K_UP, pygame.K_DOWN, pygame.K_RIGHT,
+                      pygame.K_LEFT, None] +
                      list(bytes(string.ascii_lowercase + string.digits, "ascii")))
 
+    ANY_INDEX = KEY_NAME_LIST.index("any")
+
     def __init__(self, key_index):
         self._key_index = key_index
 
@@ -42,29 +121,29 @@ class HatKeyPressed(HatBase):
     def code_to_index(cls, code):
         return cls.KEY_CODE_LIST.index(code)
 
+    def get_name(self):
+        return self.KEY_NAME_LIST[self._key_index]
+
     @classmethod
     def from_name(cls, name):
         return cls(cls.name_to_index(name))
 
     @classmethod
     def from_code(cls, code):
+        # Keys without a hat of their own still activate "any" hats
+        if code not in cls.KEY_CODE_LIST:
+            return cls(cls.ANY_INDEX)
         return cls(cls.code_to_index(code))
 
-    def __eq__(self, other):
-        if type(self) != type(other):
-            return False
+    def get_key(self):
+        return (type(self), self._key_index)
 
-        if self._key_index == 0xFFFF or other._key_index == 0xFFFF:
-            return True
-        
-        if self._key_index != other._key_index:
-            return False
+    def get_wildcard_key(self):
+        return (type(self), self.ANY_INDEX)
 
-        return True
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.get_name())
 
-    def __hash__(self):
-        return hash(self._key_index)
-        
 
 class HatSpriteClicked(HatBase):
     def condition(self, data, env, sprite):
@@ -75,17 +154,11 @@ class HatString(HatBase):
     def __init__(self, string):
         self._string = string
 
-    def __eq__(self, other):
-        if type(self) != type(other):
-            return False
-        
-        if self._string != other._string:
-            return False
-
-        return True
+    def get_string(self):
+        return self._string
 
-    def __hash__(self):
-        return hash(self._string)
+    def get_key(self):
+        return (type(self), self._string)
 
 
 class HatBackdropSwitches(HatString):
@@ -93,24 +166,292 @@ class HatBackdropSwitches(HatString):
 
 
 class HatReceived(HatString):
-    pass
+    RESTART = True
 
 
 class Task:
-    def __init__(self, sprite, action):
+    def __init__(self, sprite, action, hat=None):
         self.sprite = sprite
         self.action = action
+        self.hat = hat
         self.activated = False
         self.thread = None
+        self.generator = None
+        self.done = threading.Event()
+
+    def finish(self):
+        self.activated = False
+        self.thread = None
+        self.generator = None
+        self.done.set()
+
+    def join(self):
+        self.done.wait()
+
+    def __str__(self):
+        return "{} {!r}".format(self.sprite, self.hat)
+
+
+class Completion:
+    def __init__(self):
+        self._delivered = threading.Event()
+        self._tasks = []
+
+    def _deliver(self, tasks):
+        self._tasks = tasks
+        self._delivered.set()
+
+    def is_done(self):
+        return (self._delivered.is_set() and
+                all(task.done.is_set() for task in self._tasks))
+
+    def wait(self):
+        self._delivered.wait()
+        for task in self._tasks:
+            task.join()
+
+
+class EventQueue:
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def post(self, hat, data=None):
+        # The same event posted again before delivery is delivered once
+        key = (hat.get_key(), data)
+        with self._lock:
+            if key not in self._events:
+                self._events[key] = (hat, data, Completion())
+            return self._events[key][2]
+
+    def deliver(self, env):
+        with self._lock:
+            events = self._events
+            self._events = {}
+
+        for hat, data, completion in events.values():
+            completion._deliver(activate_hats(hat, data, env))
+
+        return len(events)
+
+
+class Pacing:
+    MODES = ("scratch", "budget", "turbo")
+
+    def __init__(self, mode="scratch", fps=40, budget=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown pacing mode {}".format(mode))
+
+        self.mode = mode
+        self.fps = fps
+
+        frame_time = 1.0 / fps
+        if mode == "turbo":
+            self.work_time = frame_time
+            self.thread_delay = 0
+        elif mode == "budget":
+            self.work_time = budget if budget is not None else 0.75 * frame_time
+            self.thread_delay = 0.001
+        else:
+            self.work_time = 0
+            self.thread_delay = frame_time
+
+
+pacing = Pacing()
+
+
+class Scheduler:
+    def __init__(self, pacing, timers=None):
+        self._pacing = pacing
+        self._running = []
+        self._lock = threading.Lock()
+
+        # Tasks parked on an Until, and the parked tasks to check again
+        # because a variable they read has changed.
+        self._parked = {}
+        self._watching = {}
+        self._woken = set()
+
+        # Tasks parked on a Sleep, and their timer entries
+        if timers is None:
+            timers = TimerWheel(1.0 / pacing.fps)
+        self._timers = timers
+        self._sleeping = {}
+
+    def start(self, task, sprite, env):
+        task.generator = task.action(sprite, env)
+        with self._lock:
+            self._running.append(task)
+
+    def restart(self, task, sprite, env):
+        task.generator = task.action(sprite, env)
+        with self._lock:
+            entry = self._sleeping.pop(task, None)
+            if entry is not None:
+                self._timers.cancel(entry)
+            if self._unpark(task) or entry is not None:
+                self._running.append(task)
+
+    def _park(self, task, until):
+        self._parked[task] = until
+        for variable in until.variables or ():
+            if variable not in self._watching:
+                self._watching[variable] = set()
+                variable.add_watcher(self._variable_changed)
+            self._watching[variable].add(task)
+
+    def _unpark(self, task):
+        until = self._parked.pop(task, None)
+        if until is None:
+            return False
+
+        self._woken.discard(task)
+        for variable in until.variables or ():
+            self._watching[variable].discard(task)
+        return True
+
+    def _stop(self, task, option):
+        if option == "this script":
+            stopped = [task]
+        elif option == "all":
+            stopped = running_tasks()
+        else:
+            # Other scripts in the sprite, or in the stage
+            stopped = [t for t in running_tasks()
+                       if t.sprite == task.sprite and t is not task]
+
+        # Threads cannot be stopped from outside
+        stopped = set(t for t in stopped if t.generator is not None)
+        with self._lock:
+            self._running = [t for t in self._running if t not in stopped]
+            if task not in stopped:
+                self._running.append(task)
+            for t in stopped:
+                self._unpark(t)
+                entry = self._sleeping.pop(t, None)
+                if entry is not None:
+                    self._timers.cancel(entry)
+
+        for t in stopped:
+            t.finish()
+
+    def _variable_changed(self, variable):
+        with self._lock:
+            self._woken.update(self._watching[variable])
+
+    def _wake(self, check_all):
+        if not (self._timers or self._woken or (check_all and self._parked)):
+            return
+
+        now = clock.now()
+        with self._lock:
+            for task in self._timers.expire(now):
+                del self._sleeping[task]
+                self._running.append(task)
+
+            if check_all:
+                candidates = list(self._parked)
+            else:
+                candidates = list(self._woken)
+            self._woken = set()
+
+        for task in candidates:
+            until = self._parked.get(task)
+            try:
+                ready = until is not None and until.condition()
+            except Exception:
+                traceback.print_exc()
+                with self._lock:
+                    self._unpark(task)
+                task.finish()
+                continue
+
+            if ready:
+                with self._lock:
+                    if self._unpark(task):
+                        self._running.append(task)
+
+    def step(self, check_all=False):
+        self._wake(check_all)
+        with self._lock:
+            tasks = self._running
+            self._running = []
+
+        busy = False
+        for task in tasks:
+            # Stopped by a script stepped earlier
+            if task.generator is None:
+                continue
+
+            try:
+                value = next(task.generator)
+            except StopIteration:
+                task.finish()
+                continue
+            except Exception:
+                traceback.print_exc()
+                task.finish()
+                continue
+
+            if isinstance(value, Stop):
+                self._stop(task, value.option)
+                continue
+
+            with self._lock:
+                if isinstance(value, Until):
+                    self._park(task, value)
+                elif isinstance(value, Sleep):
+                    self._sleeping[task] = self._timers.schedule(value.deadline, task)
+                else:
+                    busy = True
+                    self._running.append(task)
+
+        return busy or bool(self._woken)
+
+    def run_frame(self):
+        start = time.perf_counter()
+        # Every parked task is checked at least once a frame
+        busy = self.step(check_all=True)
+        if self._pacing.mode == "scratch":
+            return
+
+        # Keep stepping until the frame's budget is spent or every
+        # script is waiting.
+        deadline = start + self._pacing.work_time
+        while busy and time.perf_counter() < deadline:
+            busy = self.step()
+
+    def is_idle(self):
+        return not (self._running or self._parked or self._sleeping)
+
+
+def _run_in_thread(task, sprite, env):
+    try:
+        if inspect.isgeneratorfunction(task.action):
+            for value in task.action(sprite, env):
+                if isinstance(value, (Until, Sleep)):
+                    value.block()
+                elif isinstance(value, Stop):
+                    # Other threads cannot be stopped from here
+                    if value.option in ("this script", "all"):
+                        return
+                else:
+                    time.sleep(pacing.thread_delay)
+        else:
+            task.action(sprite, env)
+    finally:
+        task.finish()
 
 
 def register(hat, sprite, action):
     global tasks_by_hat
 
-    if hat not in tasks_by_hat:
-        tasks_by_hat[hat] = []
+    tasks_by_hat.setdefault(hat.get_key(), []).append(Task(sprite, action, hat))
+
 
-    tasks_by_hat[hat].append(Task(sprite, action))
+def running_tasks():
+    return [task for tasks in list(tasks_by_hat.values())
+            for task in tasks if task.activated]
 
 
 def register_scratch_tasks(sprite):
@@ -161,22 +502,33 @@ def when_received(message):
 
 def activate_hats(hat, data, env):
     activated = []
-    tasks = tasks_by_hat[hat] if hat in tasks_by_hat else []
+    key = hat.get_key()
+    tasks = tasks_by_hat.get(key, [])
+
+    wildcard = hat.get_wildcard_key()
+    if wildcard is not None and wildcard != key:
+        tasks = tasks + tasks_by_hat.get(wildcard, [])
 
     for t in tasks:
         sprite = env.get_sprite_by_name(t.sprite)
-        
-        if t.thread and not t.thread.is_alive():
-            t.activated = False
-            t.thread = None
-            
-        if not t.activated and hat.condition(data, env, sprite):
-            t.thread = Thread(target=t.action, args=(sprite, env))
-            t.thread.daemon = True
+
+        if t.activated:
+            # Only scheduled scripts can be started over, a thread
+            # cannot be stopped from outside.
+            if hat.RESTART and t.generator is not None:
+                scheduler.restart(t, sprite, env)
+                activated.append(t)
+            continue
+
+        if hat.condition(data, env, sprite):
             t.activated = True
-            t.thread.start()
-            activated.append(t.thread)
+            t.done.clear()
+            if scheduler is not None and inspect.isgeneratorfunction(t.action):
+                scheduler.start(t, sprite, env)
+            else:
+                t.thread = Thread(target=_run_in_thread, args=(t, sprite, env))
+                t.thread.daemon = True
+                t.thread.start()
+            activated.append(t)
 
     return activated
-
-        
@@ -0,0 +1,69 @@
+import threading
+
+from collections import defaultdict
+
+
+def bb_overlap(bb1, bb2):
+    return not ((bb1.x > bb2.x + bb2.w - 1) or # is b1 on the right side of b2?
+                (bb1.y > bb2.y + bb2.h - 1) or # is b1 under b2?
+                (bb2.x > bb1.x + bb1.w - 1) or # is b2 on the right side of b1?
+                (bb2.y > bb1.y + bb1.h - 1))   # is b2 under b1?
+
+
+class SpatialHash:
+    def __init__(self, cell_size=64):
+        self._cell_size = cell_size
+        self._cells = defaultdict(set)
+        self._entries = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def mark(self, item):
+        with self._lock:
+            self._dirty.add(item)
+
+    def _unlink(self, item):
+        entry = self._entries.pop(item, None)
+        if entry is None:
+            return
+
+        for cell in entry[1]:
+            members = self._cells[cell]
+            members.discard(item)
+            if not members:
+                del self._cells[cell]
+
+    def _cells_for(self, bb):
+        size = self._cell_size
+        return [(cx, cy)
+                for cx in range(bb.x // size, (bb.x + max(bb.w, 1) - 1) // size + 1)
+                for cy in range(bb.y // size, (bb.y + max(bb.h, 1) - 1) // size + 1)]
+
+    def _refresh(self):
+        while self._dirty:
+            item = self._dirty.pop()
+            self._unlink(item)
+
+            bb = item.get_bb()
+            cells = self._cells_for(bb)
+            self._entries[item] = (bb, cells)
+            for cell in cells:
+                self._cells[cell].add(item)
+
+    def get_bb(self, item):
+        with self._lock:
+            self._refresh()
+            return self._entries[item][0]
+
+    def query(self, item):
+        with self._lock:
+            self._refresh()
+            bb, cells = self._entries[item]
+
+            found = set()
+            for cell in cells:
+                found.update(self._cells[cell])
+            found.discard(item)
+
+            return [(other, self._entries[other][0]) for other in found
+                    if bb_overlap(bb, self._entries[other][0])]
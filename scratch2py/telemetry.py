@@ -0,0 +1,78 @@
+import sys
+import csv
+import json
+import time
+import threading
+
+from collections import deque
+
+
+class FrameTimer:
+    # Decode time is also part of the phase the costume was loaded in
+    PHASES = ("events", "hats", "scripts", "draw", "flip", "decode")
+
+    def __init__(self, budget, window=256, trace=False, work_time=0):
+        self._budget = budget
+        # Script time the pacing gives each frame on top of the budget
+        self._work_time = work_time
+        self._totals = deque(maxlen=window)
+        self._trace = [] if trace else None
+        self._lock = threading.Lock()
+        self._frame = 0
+        self._times = None
+        self._start = None
+        self._last = None
+
+    def begin(self):
+        self._start = self._last = time.perf_counter()
+        with self._lock:
+            self._times = dict.fromkeys(self.PHASES, 0.0)
+
+    def mark(self, phase):
+        if self._times is None:
+            return
+        now = time.perf_counter()
+        self._times[phase] += now - self._last
+        self._last = now
+
+    def add(self, phase, seconds):
+        with self._lock:
+            if self._times is not None:
+                self._times[phase] += seconds
+
+    def end(self, get_running):
+        total = time.perf_counter() - self._start
+        with self._lock:
+            times = self._times
+        self._totals.append(total)
+        self._frame += 1
+
+        over = total - min(times["scripts"], self._work_time) > self._budget
+        if self._trace is not None:
+            self._trace.append([self._frame, total] +
+                               [times[phase] for phase in self.PHASES] + [over])
+
+        if over:
+            phases = ", ".join("{} {:.1f}".format(phase, times[phase] * 1000)
+                               for phase in self.PHASES if times[phase] > 0)
+            running = ", ".join(get_running()) or "none"
+            print("Frame {} took {:.1f} ms ({}), running: {}".format(
+                self._frame, total * 1000, phases, running), file=sys.stderr)
+
+    def percentiles(self, *percents):
+        totals = sorted(self._totals)
+        if not totals:
+            return [0.0 for p in percents]
+        return [totals[min(len(totals) - 1, int(len(totals) * p / 100))]
+                for p in percents]
+
+    def write_trace(self, filename):
+        columns = ["frame", "total"] + list(self.PHASES) + ["over_budget"]
+        if filename.endswith(".json"):
+            with open(filename, "w") as fobj:
+                json.dump([dict(zip(columns, row)) for row in self._trace], fobj)
+        else:
+            with open(filename, "w", newline="") as fobj:
+                writer = csv.writer(fobj)
+                writer.writerow(columns)
+                writer.writerows(self._trace)
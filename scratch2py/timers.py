@@ -0,0 +1,62 @@
+import threading
+
+
+class TimerWheel:
+    # One slot per tick, wrapping around every size ticks. Entries due
+    # more than a turn ahead stay in their slot until their deadline.
+    def __init__(self, tick, size=512):
+        self._tick = tick
+        self._slots = [[] for i in range(size)]
+        self._next = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, item):
+        entry = [deadline, item]
+        tick = int(deadline // self._tick)
+        with self._lock:
+            # Ticks before the next one have been expired already
+            if self._next is not None:
+                tick = max(tick, self._next)
+            self._slots[tick % len(self._slots)].append(entry)
+            self._count += 1
+        return entry
+
+    def cancel(self, entry):
+        # Cancelled entries are dropped when their slot comes round
+        with self._lock:
+            if entry[1] is not None:
+                entry[1] = None
+                self._count -= 1
+
+    def expire(self, now):
+        current = int(now // self._tick)
+        due = []
+        with self._lock:
+            if not self._count:
+                self._next = current
+                return due
+
+            size = len(self._slots)
+            first = current - size + 1
+            if self._next is not None:
+                first = max(first, self._next)
+            for tick in range(first, current + 1):
+                index = tick % size
+                pending = []
+                for entry in self._slots[index]:
+                    if entry[1] is None:
+                        continue
+                    if entry[0] <= now:
+                        due.append(entry[1])
+                        self._count -= 1
+                    else:
+                        pending.append(entry)
+                self._slots[index] = pending
+
+            self._next = current
+
+        return due
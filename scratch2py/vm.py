@@ -1,55 +1,276 @@
+import math
 import time
 import keyword
 import random
+import inspect
+import threading
+import functools
 
 from . import sb
 
+STACK_INPUTS = ("substack", "substack2")
+
+# Reporters without side effects, computed once while parsing when all
+# their inputs are constant.
+PURE_OPCODES = {
+    "operator_add", "operator_subtract", "operator_multiply", "operator_divide",
+    "operator_mod", "operator_round", "operator_mathop", "operator_gt",
+    "operator_lt", "operator_equals", "operator_and", "operator_or",
+    "operator_not", "operator_join", "operator_letter_of", "operator_length",
+    "operator_contains",
+}
+
+# Inputs whose variables are watched, so that a waiting script is only
+# checked again once what it waits for may have changed.
+WATCHED_INPUTS = {
+    "control_wait_until": "condition",
+}
+
+# Inputs that are always converted to numbers, which constant inputs
+# can be converted to once.
+NUMERIC_INPUTS = {
+    "operator_add": ("num1", "num2"),
+    "operator_subtract": ("num1", "num2"),
+    "operator_multiply": ("num1", "num2"),
+    "operator_divide": ("num1", "num2"),
+    "operator_round": ("num",),
+    "operator_mathop": ("num",),
+    "data_changevariableby": ("value",),
+}
+
+class Stats:
+    def __init__(self):
+        self.blocks = 0
+
+    def wrap(self, opcode, step, is_generator):
+        return step
+
+    def wrap_script(self, sprite, script, code):
+        return code
+
+    def wrap_condition(self, condition):
+        return condition
+
+
+class Profiler(Stats):
+    def __init__(self):
+        super().__init__()
+        # Calls, total and self time by (sprite, script, opcode)
+        self.ops = {}
+        # Self time by stack, in flamegraph's folded format
+        self.stacks = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _enter(self, opcode):
+        stack = self._local.stack
+        path = stack[-1][0] + ";" + opcode
+        stack.append([path, opcode, time.perf_counter(), 0.0])
+
+    def _exit(self, calls):
+        end = time.perf_counter()
+        stack = self._local.stack
+        path, opcode, start, child = stack.pop()
+        total = end - start
+        own = total - child
+
+        with self._lock:
+            self.stacks[path] = self.stacks.get(path, 0.0) + own
+            if stack:
+                stack[-1][3] += total
+                entry = self.ops.setdefault(stack[0][1] + (opcode,), [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] += own
+
+    def wrap(self, opcode, step, is_generator):
+        if not is_generator:
+            def run():
+                self._enter(opcode)
+                try:
+                    return step()
+                finally:
+                    self._exit(1)
+
+            return run
+
+        # Only the time spent running counts, not the time suspended
+        def run_generator():
+            gen = step()
+            calls = 1
+            while True:
+                self._enter(opcode)
+                try:
+                    value = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit(calls)
+                calls = 0
+                yield value
+
+        return run_generator
+
+    def wrap_script(self, sprite, script, code):
+        root = (sprite, script)
+        path = "{};{}".format(sprite.replace(";", "_"), script.replace(";", "_"))
+
+        def run():
+            gen = code()
+            while True:
+                self._local.stack = [[path, root, time.perf_counter(), 0.0]]
+                try:
+                    value = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit(0)
+                yield value
+
+        return run
+
+    def wrap_condition(self, condition):
+        # Parked scripts have their conditions checked by the scheduler,
+        # outside of their steps. The time still counts for the script.
+        path, root = self._local.stack[0][:2]
+
+        def run():
+            self._local.stack = [[path, root, time.perf_counter(), 0.0]]
+            try:
+                return condition()
+            finally:
+                self._exit(0)
+
+        return run
+
+    def write_folded(self, fobj):
+        for path, seconds in sorted(self.stacks.items()):
+            usecs = int(seconds * 1e6)
+            if usecs > 0:
+                fobj.write("{} {}\n".format(path, usecs))
+
+
 class IEval:
-    def eval(self, vm):
-        raise NotImplementedError("eval")
+    __slots__ = ()
+
+    def compile(self, vm):
+        raise NotImplementedError("compile")
 
 
 class Color(IEval):
     def __init__(self, string):
+        self._string = string
         string = string[1:]
         self.red = int(string[1:3], 16)
         self.green = int(string[3:5], 16)
         self.blue = int(string[5:6], 16)
 
-    def eval(self, vm):
-        return self
+    def get_string(self):
+        return self._string
+
+    def compile(self, vm):
+        return lambda: self
 
 
 class Variable(IEval):
-    def __init__(self, name, value):
+    __slots__ = ("_name", "_values", "_slot", "_watchers", "visible")
+
+    def __init__(self, name, values, slot):
         self._name = name
-        self._value = value
+        self._values = values
+        self._slot = slot
+        self._watchers = None
+        self.visible = False
 
     def set_value(self, value):
-        self._value = value
+        self._values[self._slot] = value
+        if self._watchers is not None:
+            for watcher in self._watchers:
+                watcher(self)
+
+    def add_watcher(self, watcher):
+        if self._watchers is None:
+            self._watchers = []
+        self._watchers.append(watcher)
+
+    def get_name(self):
+        return self._name
 
     def get_value(self):
-        return self._value
+        return self._values[self._slot]
 
-    def eval(self, vm):
-        return self._value
+    def compile(self, vm):
+        values = self._values
+        slot = self._slot
+        return lambda: values[slot]
+
+
+class VariableStore:
+    def __init__(self):
+        # Variables and lists of one target, by slot. The names are
+        # only looked up while parsing.
+        self.values = []
+        self._variables = {}
+        self._lists = {}
+
+    def _add(self, names, name, value):
+        variable = Variable(name, self.values, len(self.values))
+        self.values.append(value)
+        names[name] = variable
+        return variable
+
+    def add_variable(self, name, value):
+        return self._add(self._variables, name, value)
+
+    def add_list(self, name, items):
+        return self._add(self._lists, name, list(items))
+
+    def get_variable(self, name):
+        return self._variables.get(name)
+
+    def get_list(self, name):
+        return self._lists.get(name)
+
+    def get_variable_map(self):
+        return self._variables
+
+    def get_list_map(self):
+        return self._lists
 
 
 class Literal(IEval):
     def __init__(self, const):
         self._const = const
 
-    def eval(self, vm):
+    def get_value(self):
         return self._const
 
+    def get_number(self):
+        try:
+            return float(self._const)
+        except (TypeError, ValueError):
+            return None
+
+    def compile(self, vm):
+        const = self._const
+        return lambda: const
+
 
 class Block:
     def __init__(self, block, parser):
         self._opcode = block["opcode"]
         self._kwargs = {}
-        
+        self._fields = set()
+
         for inp, arg in block["fields"].items():
-            self._kwargs[inp.lower()] = arg[0]
+            kw = inp.lower()
+            if kw == "variable":
+                self._kwargs[kw] = parser.get_variable(arg[0])
+            elif kw == "list":
+                self._kwargs[kw] = parser.get_list(arg[0])
+            else:
+                self._kwargs[kw] = arg[0]
+            self._fields.add(kw)
 
         for inp, arg in block["inputs"].items():
             self._kwargs[inp.lower()] = self._parse_arg(arg[1], parser)
@@ -78,18 +299,86 @@ class Block:
         else:
             raise ValueError("unknown data type {}".format(arg[0]))
             
-    def execute(self, vm):
-        if self._opcode.startswith("event_"):
-            return
-        
+    def get_opcode(self):
+        return self._opcode
+
+    def get_args(self):
+        return self._kwargs
+
+    def fold(self):
+        # Simplifies the inputs, and returns a Literal for a pure
+        # reporter whose inputs are all constant.
+        numeric = NUMERIC_INPUTS.get(self._opcode, ())
+        for kw, arg in self._kwargs.items():
+            if kw in self._fields:
+                continue
+            if isinstance(arg, Script):
+                arg = arg.simplify() if kw in STACK_INPUTS else arg.fold()
+            if kw in numeric and isinstance(arg, Literal) and arg.get_number() is not None:
+                arg = Literal(arg.get_number())
+            self._kwargs[kw] = arg
+
+        if self._opcode not in PURE_OPCODES:
+            return None
+
+        for kw, arg in self._kwargs.items():
+            if kw not in self._fields and not isinstance(arg, Literal):
+                return None
+
+        try:
+            return Literal(self.compile(CONSTANT_VM)())
+        except Exception:
+            # Left to fail when the block runs
+            return None
+
+    def simplify(self):
+        # Returns the blocks that take this block's place in a stack
+        self.fold()
+        args = self._kwargs
+
+        if self._opcode == "control_if":
+            condition = args.get("condition")
+            substack = args.get("substack")
+            if condition is None:
+                return []
+            elif isinstance(condition, Literal):
+                if condition.get_value() and substack is not None:
+                    return substack.get_blocks()
+                return []
+        elif self._opcode == "control_repeat":
+            # Only repeat: wait 0 is kept, as it still yields for a frame
+            count = args.get("times")
+            if isinstance(count, Literal) and (count.get_number() or 0) <= 0:
+                return []
+        elif self._opcode in ("motion_changexby", "motion_changeyby",
+                              "motion_movesteps"):
+            delta = args.get("dx", args.get("dy", args.get("steps")))
+            if isinstance(delta, Literal) and delta.get_number() == 0:
+                return []
+
+        return [self]
+
+    def compile(self, vm):
+        if self._opcode.startswith("event_when"):
+            return None
+
         method = getattr(vm, "op_" + self._opcode)
-        for kw in keyword.kwlist:
-            if kw in self._kwargs:
-                val = self._kwargs[kw]
-                self._kwargs[kw + "_"] = val
-                self._kwargs.pop(kw)
-                
-        return method(**self._kwargs)
+        kwargs = {}
+        for kw, arg in self._kwargs.items():
+            if kw in self._fields:
+                pass
+            elif isinstance(arg, Script) and kw in STACK_INPUTS:
+                arg = arg.compile_stack(vm)
+            elif isinstance(arg, IEval):
+                arg = arg.compile(vm)
+            if keyword.iskeyword(kw):
+                kw = kw + "_"
+            kwargs[kw] = arg
+
+        if self._opcode in WATCHED_INPUTS:
+            kwargs["watch"] = get_dependencies(self._kwargs.get(WATCHED_INPUTS[self._opcode]))
+
+        return functools.partial(method, **kwargs)
 
     def __str__(self):
         return "Block({})".format(self._opcode)
@@ -106,35 +395,108 @@ class Script(IEval):
             self._seq.append(b)
             bid = block["next"]
 
-    def eval(self, vm):
-        retval = None
+    def get_blocks(self):
+        return self._seq
+
+    def fold(self):
+        constants = [block.fold() for block in self._seq]
+        if len(constants) == 1 and constants[0] is not None:
+            return constants[0]
+        return self
+
+    def simplify(self):
+        seq = []
+        for block in self._seq:
+            seq.extend(block.simplify())
+        self._seq = seq
+        return self
+
+    def _compile_steps(self, vm):
+        stats = vm.get_stats()
+        steps = []
         for block in self._seq:
-            retval = block.execute(vm)
-            import time
-            time.sleep(0.001)
-        return retval
+            step = block.compile(vm)
+            if step is None:
+                continue
+
+            is_generator = inspect.isgeneratorfunction(step.func)
+            if stats is not None:
+                step = stats.wrap(block.get_opcode(), step, is_generator)
+            steps.append((step, is_generator))
+
+        return steps
+
+    def compile(self, vm):
+        seq = [step for step, is_generator in self._compile_steps(vm)]
+
+        stats = vm.get_stats()
+
+        if stats is None:
+            def run():
+                retval = None
+                for step in seq:
+                    retval = step()
+                return retval
+        else:
+            def run():
+                retval = None
+                for step in seq:
+                    stats.blocks += 1
+                    retval = step()
+                return retval
+
+        return run
+
+    def compile_stack(self, vm):
+        seq = self._compile_steps(vm)
+
+        stats = vm.get_stats()
+
+        if stats is None:
+            def run():
+                for step, is_generator in seq:
+                    if is_generator:
+                        yield from step()
+                    else:
+                        step()
+        else:
+            def run():
+                for step, is_generator in seq:
+                    stats.blocks += 1
+                    if is_generator:
+                        yield from step()
+                    else:
+                        step()
+
+        return run
 
     def __repr__(self):
         return "\n".join(str(block) for block in self._seq)
 
 
 class Parser:
-    def __init__(self, sprite_info, gvars):
+    def __init__(self, sprite_info, gvars, parsed=None):
         self._sinfo = sprite_info
         self._gvars = gvars
-        self._lvars = {}
-        self._hats = []
-
         self.blocks = self._sinfo["blocks"]
 
-        self._parse_blocks()
+        # Variables and scripts from an earlier parse of the project
+        if parsed is not None:
+            self._lvars, self._hats = parsed
+            return
+
+        self._lvars = VariableStore()
+        self._hats = []
+
         self._parse_variables()
+        self._parse_blocks()
 
     def _parse_variables(self):
         for vid, vinfo in self._sinfo["variables"].items():
-            name = vinfo[0]
-            value = vinfo[1]
-            self._lvars[name] = Variable(name, value)
+            self._lvars.add_variable(vinfo[0], vinfo[1])
+
+        for lid, linfo in self._sinfo.get("lists", {}).items():
+            self._lvars.add_list(linfo[0], linfo[1])
 
     def _parse_blocks(self):
         self._hats = []
@@ -151,30 +513,127 @@ class Parser:
                         key = block["fields"]["KEY_OPTION"][0]
                         hat = sb.HatKeyPressed.from_name(key)
 
+                    elif block["opcode"] == "event_whenbroadcastreceived":
+                        message = block["fields"]["BROADCAST_OPTION"][0]
+                        hat = sb.HatReceived(message)
+
                     if hat is not None:
-                        self._hats.append((script, hat))
+                        self._hats.append((script.simplify(), hat))
 
     def get_hats(self):
         return self._hats
 
-    def get_variable_map(self):
+    def get_parsed(self):
+        return self._lvars, self._hats
+
+    def compile(self, vm):
+        stats = vm.get_stats()
+        compiled = []
+        for i, (script, hat) in enumerate(self._hats):
+            code = script.compile_stack(vm)
+            if stats is not None:
+                label = "{}:{!r}".format(i, hat)
+                code = stats.wrap_script(self._sinfo["name"], label, code)
+            compiled.append((code, hat))
+
+        return compiled
+
+    def get_variables(self):
         return self._lvars
 
     def get_variable(self, var):
-        try:
-            return self._lvars[var]
-        except KeyError:
-            try:
-                return self._gvars[var]
-            except KeyError:
-                raise ValueError("Invalid variable name {}".format(var))
+        return find_variable(self._lvars, self._gvars, var)
+
+    def get_list(self, name):
+        return find_list(self._lvars, self._gvars, name)
+
+
+def find_variable(lvars, gvars, name):
+    variable = lvars.get_variable(name)
+    if variable is None and gvars is not None:
+        variable = gvars.get_variable(name)
+    if variable is None:
+        raise ValueError("Invalid variable name {}".format(name))
+    return variable
+
+
+def find_list(lvars, gvars, name):
+    variable = lvars.get_list(name)
+    if variable is None and gvars is not None:
+        variable = gvars.get_list(name)
+    if variable is None:
+        raise ValueError("Invalid list name {}".format(name))
+    return variable
+
+
+def get_dependencies(arg):
+    # The variables an input reads, or None when it reads anything
+    # else that can change.
+    if arg is None or isinstance(arg, (str, Literal, Color)):
+        return set()
+    elif isinstance(arg, Variable):
+        return {arg}
+    elif isinstance(arg, Script):
+        variables = set()
+        for block in arg.get_blocks():
+            if block.get_opcode() not in PURE_OPCODES:
+                return None
+            for value in block.get_args().values():
+                found = get_dependencies(value)
+                if found is None:
+                    return None
+                variables |= found
+        return variables
+    return None
+
+
+def to_number(value):
+    # Scratch takes anything that is not a number as 0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def list_index(index, length):
+    if index == "last":
+        return length - 1
+    elif index in ("random", "any"):
+        return random.randrange(length) if length else -1
+
+    try:
+        return int(float(index)) - 1
+    except ValueError:
+        return -1
+
+
+def compare(op1, op2):
+    try:
+        num1 = float(op1)
+        num2 = float(op2)
+
+        return num1 - num2
+    except ValueError:
+        str1 = op1.lower()
+        str2 = op2.lower()
+
+        if str1 < str2:
+            return -1
+        elif str1 > str2:
+            return 1
+        else:
+            return 0
 
 
 class VM:
-    def __init__(self, target, gvars):
+    def __init__(self, target, gvars, stats=None):
         self._target = target
         self._gvars = gvars
         self._lvars = target.get_variables()
+        self._stats = stats
+
+    def get_stats(self):
+        return self._stats
 
     def op_unsupported(self, **kwargs):
         print(kwargs)
@@ -186,34 +645,87 @@ class VM:
         raise AttributeError(attr)
 
     def op_control_stop(self, stop_option):
-        # FIXME: Stop all threads?
-        exit(0)
+        if stop_option == "all":
+            self._target.get_env().stop_all()
+        yield sb.Stop(stop_option)
 
     def op_control_wait(self, duration):
-        time.sleep(self._eval(duration))
+        yield sb.Sleep(sb.clock.now() + float(self._eval(duration)))
 
     def op_control_forever(self, substack):
         while True:
-            self._eval(substack)
+            if substack is not None:
+                yield from substack()
+            yield
 
     def op_control_repeat(self, times, substack):
         for i in range(self._eval(times)):
-            self._eval(substack)
+            if substack is not None:
+                yield from substack()
+            yield
 
     def op_control_if(self, condition, substack):
-        if self._eval(condition):
-            self._eval(substack)
+        if self._eval(condition) and substack is not None:
+            yield from substack()
+
+    def op_control_wait_until(self, condition, watch=None):
+        if not self._eval(condition):
+            if self._stats is not None:
+                condition = self._stats.wrap_condition(condition)
+            yield sb.Until(condition, watch)
 
-    def op_control_wait_until(self, condition):
-        while not self._eval(condition):
-            pass
+    def op_event_broadcast(self, broadcast_input):
+        self._target.get_env().broadcast(self._eval(broadcast_input))
+
+    def op_event_broadcastandwait(self, broadcast_input):
+        env = self._target.get_env()
+        completion = env.broadcast(self._eval(broadcast_input))
+        if not completion.is_done():
+            yield sb.Until(completion.is_done)
 
     def op_looks_say(self, message):
         return self._target.say(self._eval(message))
 
+    def op_looks_think(self, message):
+        return self._target.think(self._eval(message))
+
+    def _bubble_for_secs(self, show, message, secs):
+        message = self._eval(message)
+        show(message)
+        yield sb.Sleep(sb.clock.now() + float(self._eval(secs)))
+
+        # Unless another bubble has replaced it meanwhile
+        bubble = self._target.get_bubble()
+        if bubble is not None and bubble[1] == message:
+            show("")
+
+    def op_looks_sayforsecs(self, message, secs):
+        yield from self._bubble_for_secs(self._target.say, message, secs)
+
+    def op_looks_thinkforsecs(self, message, secs):
+        yield from self._bubble_for_secs(self._target.think, message, secs)
+
     def op_looks_nextcostume(self):
         return self._target.next_costume()
 
+    def op_looks_gotofrontback(self, front_back):
+        if front_back == "front":
+            self._target.go_to_front()
+        else:
+            self._target.go_to_back()
+
+    def op_looks_goforwardbackwardlayers(self, forward_backward, num):
+        layers = int(self._eval(num))
+        if forward_backward == "backward":
+            layers = -layers
+        self._target.go_forward_layers(layers)
+
+    def op_looks_show(self):
+        self._target.show()
+
+    def op_looks_hide(self):
+        self._target.hide()
+
     def op_motion_yposition(self):
         return self._target.y
 
@@ -223,6 +735,32 @@ class VM:
     def op_motion_movesteps(self, steps):
         return self._target.move(self._eval(steps))
 
+    def _glide(self, secs, x, y):
+        target = self._target
+        secs = float(self._eval(secs))
+        start = sb.clock.now()
+        x0, y0 = target.x, target.y
+        frame = 1.0 / sb.pacing.fps
+
+        elapsed = 0
+        while elapsed < secs:
+            fraction = elapsed / secs
+            target.go_to_xy(x0 + (x - x0) * fraction, y0 + (y - y0) * fraction)
+            yield sb.Sleep(sb.clock.now() + frame)
+            elapsed = sb.clock.now() - start
+
+        target.go_to_xy(x, y)
+
+    def op_motion_glidesecstoxy(self, secs, x, y):
+        yield from self._glide(secs, float(self._eval(x)), float(self._eval(y)))
+
+    def op_motion_glideto_menu(self, to):
+        return to
+
+    def op_motion_glideto(self, secs, to):
+        x, y = self._target.get_env().get_position(self._eval(to))
+        yield from self._glide(secs, x, y)
+
     def op_motion_ifonedgebounce(self):
         return self._target.if_on_edge_bounce()
 
@@ -231,30 +769,13 @@ class VM:
 
     def op_sensing_touchingobject(self, touchingobjectmenu):
         sprite = self._eval(touchingobjectmenu)
+        # Not in Scratch's menu, for generated and hand-written code
+        if sprite == "_any_":
+            return bool(self._target.touching_any())
         return self._target.touching(sprite)
 
     def _compare(self, operand1, operand2):
-        op1 = self._eval(operand1)
-        op2 = self._eval(operand2)
-
-        try:
-            num1 = float(op1)
-            num2 = float(op2)
-
-            return num1 - num2
-        except ValueError:
-            str1 = op1
-            str2 = op2
-
-            str1 = str1.lower()
-            str2 = str2.lower()
-
-            if str1 < str2:
-                return -1
-            elif str1 > str2:
-                return 1
-            else:
-                return 0
+        return compare(self._eval(operand1), self._eval(operand2))
 
     def op_operator_gt(self, operand1, operand2):
         return self._compare(operand1, operand2) > 0
@@ -299,7 +820,7 @@ class VM:
         return self._eval(string1).lower() in self._eval(string2).lower()
 
     def op_operator_round(self, num):
-        return math.round(self._eval(num))
+        return math.floor(float(self._eval(num)) + 0.5)
 
     def op_operator_mod(self, num1, num2):
         return self._eval(num1) % self._eval(num2)
@@ -308,7 +829,7 @@ class VM:
         return float(self._eval(num1)) + float(self._eval(num2))
 
     def op_operator_subtract(self, num1, num2):
-        return float(self._eval(num1)) + float(self._eval(num2))
+        return float(self._eval(num1)) - float(self._eval(num2))
 
     def op_operator_multiply(self, num1, num2):
         return float(self._eval(num1)) * float(self._eval(num2))
@@ -322,20 +843,20 @@ class VM:
             "floor": math.floor,
             "ceiling": math.ceil,
             "sqrt": math.sqrt,
-            "sin": math.sin,
-            "cos": math.cos,
-            "tan": math.tan,
-            "asin": math.asin,
-            "acos": math.acos,
-            "atan": math.atan,
+            "sin": lambda x: math.sin(math.radians(x)),
+            "cos": lambda x: math.cos(math.radians(x)),
+            "tan": lambda x: math.tan(math.radians(x)),
+            "asin": lambda x: math.degrees(math.asin(x)),
+            "acos": lambda x: math.degrees(math.acos(x)),
+            "atan": lambda x: math.degrees(math.atan(x)),
             "ln": math.log,
             "log": math.log10,
-            "e ^": lambda x: math.pow(e, x),
+            "e ^": math.exp,
             "10 ^": lambda x: math.pow(10, x)
         }
-        
-        op = mathops[self.eval(operator)]
-        return op(self.eval(num))
+
+        op = mathops[operator]
+        return op(float(self._eval(num)))
 
     def op_motion_changexby(self, dx):
         self._target.x += int(self._eval(dx))
@@ -353,23 +874,92 @@ class VM:
         self._target.point_in_direction(self._eval(direction))
 
     def op_data_setvariableto(self, variable, value):
-        self.get_variable(variable).set_value(self._eval(value))
+        variable.set_value(self._eval(value))
+
+    def op_data_changevariableby(self, variable, value):
+        variable.set_value(to_number(variable.get_value()) + to_number(self._eval(value)))
+
+    def op_data_showvariable(self, variable):
+        variable.visible = True
+
+    def op_data_hidevariable(self, variable):
+        variable.visible = False
+
+    def op_data_addtolist(self, item, list):
+        list.get_value().append(self._eval(item))
+
+    def op_data_deleteoflist(self, index, list):
+        items = list.get_value()
+        index = self._eval(index)
+        if index == "all":
+            del items[:]
+            return
+
+        index = list_index(index, len(items))
+        if 0 <= index < len(items):
+            del items[index]
+
+    def op_data_deletealloflist(self, list):
+        del list.get_value()[:]
+
+    def op_data_insertatlist(self, item, index, list):
+        items = list.get_value()
+        index = list_index(self._eval(index), len(items) + 1)
+        if 0 <= index <= len(items):
+            items.insert(index, self._eval(item))
+
+    def op_data_replaceitemoflist(self, index, list, item):
+        items = list.get_value()
+        index = list_index(self._eval(index), len(items))
+        if 0 <= index < len(items):
+            items[index] = self._eval(item)
+
+    def op_data_itemoflist(self, index, list):
+        items = list.get_value()
+        index = list_index(self._eval(index), len(items))
+        if 0 <= index < len(items):
+            return items[index]
+        return ""
+
+    def op_data_itemnumoflist(self, item, list):
+        item = str(self._eval(item))
+        for i, value in enumerate(list.get_value()):
+            if compare(str(value), item) == 0:
+                return i + 1
+        return 0
+
+    def op_data_lengthoflist(self, list):
+        return len(list.get_value())
+
+    def op_data_listcontainsitem(self, list, item):
+        return self.op_data_itemnumoflist(item, list) > 0
+
+    def op_data_showlist(self, list):
+        list.visible = True
+
+    def op_data_hidelist(self, list):
+        list.visible = False
 
     def _eval(self, arg):
-        return arg.eval(self)
+        return arg()
 
-    def get_runner(self, script):
+    def get_runner(self, code):
         def run(sprite, env):
-            self._eval(script)
+            yield from code()
 
         return run
 
     def get_variable(self, var):
-        try:
-            return self._lvars[var]
-        except KeyError:
-            try:
-                return self._gvars[var]
-            except KeyError:
-                raise ValueError("Invalid variable name {}".format(var))
+        return find_variable(self._lvars, self._gvars, var)
+
+    def get_list(self, name):
+        return find_list(self._lvars, self._gvars, name)
+
+
+class ConstantVM(VM):
+    # Runs pure reporters while parsing, with no target
+    def __init__(self):
+        pass
+
 
+CONSTANT_VM = ConstantVM()